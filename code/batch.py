@@ -0,0 +1,457 @@
+#-- Batched stepping of many rovers at once, for large simulations and parameter sweeps.
+#-- RoverBatch holds the state of N rovers as a struct of arrays (one array per RoverState
+#-- attribute, modes as Mode codes) and batch_perception_step / batch_decision_step
+#-- apply perception_step / decision_step to all of them with whole-batch NumPy operations:
+#-- the stacked camera images are classified in one pass and projected into world coordinates with per-pixel rover poses.
+#-- Only the occupancy grid updates run per rover, since every rover has its own map. The map
+#-- update policy of perception_step (pitch/roll gate, map_update_due and map_cache) is applied
+#-- per rover, so each rover's map is the same as with perception_step.
+#--
+#-- The batched decision tree follows decision_step mode by mode. Exploration uses the
+#-- nav_adjust wall hugging and go_home heads straight for home: the frontier tracker and
+#-- the home planner are per map objects and are not part of the batch.
+#--
+#-- Example:
+#--   batch = RoverBatch(64)
+#--   batch.set_telemetry(i, telemetry_decoder.decode(data))   # for every rover i
+#--   batch_perception_step(batch)
+#--   batch_decision_step(batch)
+import numpy as np
+import cv2
+
+from perception import (get_warp_engine, get_color_classifier, get_rover_grid,
+                        map_update_allowed, PIXELS_PER_METER)
+from worldmap import OccupancyGrid, WorldCellCache, cell_keys
+from supporting_functions import MapStats
+from rover_state import RoverState, Mode, ground_truth_3d
+
+#-- Mode codes (rover_state.Mode) as plain ints for the array compares
+START, FORWARD, STOP, VIS_TARGET, PICKUP, STUCK, GO_HOME = (int(mode) for mode in Mode)
+
+#-- Distance (pixels) within which obstacle pixels count as directly in front, as in decision_step
+OBS_CLOSE = 10
+
+#-- RoverState attributes that are tuning parameters of perception and decision
+PARAMETERS = ('throttle_set', 'brake_set', 'brake_nom', 'stop_forward', 'go_forward', 'max_vel',
+              'nav_adjust', 'nav_close', 'home_prox', 'pitch_max', 'roll_max',
+              'map_min_move', 'map_min_turn', 'map_max_skip')
+
+#-- State of N rovers as a struct of arrays. Attribute names and units follow RoverState.
+#-- Per rover parameters (throttle_set, stop_forward, ...) are arrays too, so a parameter
+#-- sweep just sets different values per rover.
+class RoverBatch():
+    def __init__(self, n, shape=(160, 320, 3), cells_per_meter=1):
+        self.n = n
+        self.shape = (shape[0], shape[1])
+        self.img = np.zeros((n,) + tuple(shape), dtype=np.uint8) # Camera images, written in place by set_telemetry
+        self.warped = np.zeros((n,) + tuple(shape), dtype=np.uint8)
+        self.vision_image = np.zeros((n,) + tuple(shape), dtype=np.uint8)
+        self.worldmaps = [OccupancyGrid(cells_per_meter=cells_per_meter) for i in range(n)]
+        self.map_stats = [MapStats(ground_truth_3d) for i in range(n)]
+        self.map_caches = [WorldCellCache() for i in range(n)] # None entries disable a rover's cache
+        self.map_pose = np.full((n, 3), np.nan) # Pose (x, y, yaw) of each rover's last map update, NaN before the first
+        self.map_skipped = np.zeros(n, dtype=np.int32)
+        # Telemetry
+        self.pos = np.zeros((n, 2))
+        self.yaw = np.zeros(n)
+        self.pitch = np.zeros(n)
+        self.roll = np.zeros(n)
+        self.vel = np.zeros(n)
+        self.near_sample = np.zeros(n, dtype=bool)
+        self.picking_up = np.zeros(n, dtype=bool)
+        # Commands
+        self.steer = np.zeros(n)
+        self.throttle = np.zeros(n)
+        self.brake = np.zeros(n)
+        self.send_pickup = np.zeros(n, dtype=bool)
+        # Decision state
+        self.mode = np.full(n, START, dtype=np.int8)
+        self.home = np.full((n, 2), np.nan) # NaN until saved in 'start' mode
+        self.count = np.zeros(n, dtype=np.int32)
+        self.count1 = np.zeros(n, dtype=np.int32)
+        self.stuck = np.zeros(n, dtype=bool)
+        self.stuck_home = np.zeros(n, dtype=bool)
+        self.obs_stuck = np.zeros(n, dtype=bool)
+        self.yaw_error = np.zeros(n)
+        self.target_yaw = np.zeros(n)
+        self.target_angle = np.zeros(n)
+        self.dist_home = np.zeros(n)
+        self.sample_count = np.zeros(n, dtype=np.int32)
+        #-- Parameters, one value per rover, starting from the RoverState defaults
+        defaults = RoverState()
+        for name in PARAMETERS:
+            setattr(self, name, np.full(n, getattr(defaults, name), dtype=np.float64))
+        #-- Per rover summaries of the polar pixel data, all the decision tree needs:
+        #-- pixel counts, mean angles (degrees) and counts / mean angles near the rover
+        self.nav_count = np.zeros(n, dtype=np.int64)
+        self.nav_mean = np.zeros(n)
+        self.nav_close_count = np.zeros(n, dtype=np.int64)
+        self.nav_close_mean = np.zeros(n)
+        self.obs_close_count = np.zeros(n, dtype=np.int64)
+        self.rock_count = np.zeros(n, dtype=np.int64)
+        self.rock_mean = np.zeros(n)
+
+    #-- Copy the decoded telemetry of rover i (TelemetryDecoder.decode output) into the batch
+    def set_telemetry(self, i, fields):
+        self.vel[i] = fields['vel']
+        self.pos[i] = fields['pos']
+        self.yaw[i] = fields['yaw']
+        self.pitch[i] = fields['pitch']
+        self.roll[i] = fields['roll']
+        self.near_sample[i] = fields['near_sample']
+        self.picking_up[i] = fields['picking_up']
+        self.img[i] = fields['img']
+
+#-- Pixel weights for the polar summaries, per image shape and nav_close distance.
+#-- Columns: navigable (1, angle, near, near * angle), obstacle (near), rock (1, angle)
+_polar_weights = {}
+
+def get_polar_weights(shape, nav_close):
+    key = (shape[0], shape[1], nav_close)
+    weights = _polar_weights.get(key)
+    if weights is None:
+        grid = get_rover_grid(shape)
+        ones = np.ones_like(grid.angles)
+        near = (grid.dist < nav_close).astype(np.float32)
+        obs_near = (grid.dist < OBS_CLOSE).astype(np.float32)
+        weights = (np.stack((ones, grid.angles, near, near * grid.angles), axis=1),
+                   obs_near[:, None].copy(),
+                   np.stack((ones, grid.angles), axis=1))
+        _polar_weights[key] = weights
+    return weights
+
+#-- Weighted pixel sums of binary images: masks (n, pixels) of 0/1 times weights (pixels, k).
+#-- Returns (n, k) sums. The masks are converted to float32 a chunk of rovers at a time
+#-- so the product runs as a matrix multiply without a full size float copy of the batch
+def _pixel_sums(masks, weights, chunk=16):
+    n = len(masks)
+    sums = np.empty((n, weights.shape[1]))
+    buf = np.empty((min(n, chunk), masks.shape[1]), dtype=np.float32)
+    for start in range(0, n, chunk):
+        block = buf[:min(chunk, n - start)]
+        np.copyto(block, masks[start:start + chunk])
+        sums[start:start + chunk] = block @ weights
+    return sums
+
+#-- map_update_due for the rovers at indices `rovers`. Returns the indices of those due a map update
+def _map_update_due(batch, rovers):
+    last = batch.map_pose[rovers]
+    moved = np.hypot(batch.pos[rovers, 0] - last[:,0], batch.pos[rovers, 1] - last[:,1])
+    turned = np.abs((batch.yaw[rovers] - last[:,2] + 180) % 360 - 180)
+    skip = (~np.isnan(last[:,0]) & (batch.map_skipped[rovers] < batch.map_max_skip[rovers])
+            & (moved < batch.map_min_move[rovers]) & (turned < batch.map_min_turn[rovers]))
+    batch.map_skipped[rovers[skip]] += 1
+    due = rovers[~skip]
+    batch.map_pose[due, :2] = batch.pos[due]
+    batch.map_pose[due, 2] = batch.yaw[due]
+    batch.map_skipped[due] = 0
+    return due
+
+#-- Add the deduplicated (obstacle, rock, navigable) cells to rover i's map
+def _update_rover_map(batch, i, cells):
+    worldmap = batch.worldmaps[i]
+    touched = worldmap.update(cells[0], cells[1], cells[2], assume_unique=True)
+    batch.map_stats[i].update(worldmap, touched)
+
+#-- Mean per rover, NaN for rovers without values (like np.mean of an empty array)
+def _mean(total, count):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+#-- perception_step for every rover of the batch
+def batch_perception_step(batch):
+    n = batch.n
+    rows, cols = batch.shape
+    pixels = rows * cols
+    # 1-2) Warp each image into the stacked output buffer
+    warp_engine = get_warp_engine(batch.shape)
+    warped = batch.warped
+    for i in range(n):
+        cv2.remap(batch.img[i], warp_engine.map_x, warp_engine.map_y, cv2.INTER_LINEAR, dst=warped[i],
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    # 3) Classify the stacked batch in a single pass
+    thresh_nav, thresh_obs, thresh_rock = get_color_classifier((n * rows, cols)).binary_images(
+        warped.reshape(n * rows, cols, 3))
+    # 4) Vision images, interleaved in one pass and scaled to 0/255
+    vision = batch.vision_image.reshape(n * rows, cols, 3)
+    cv2.merge((thresh_obs, thresh_rock, thresh_nav), dst=vision)
+    np.multiply(vision, 255, out=vision)
+    masks = [thresh.reshape(n, pixels) for thresh in (thresh_obs, thresh_rock, thresh_nav)]
+
+    # 5-6) World coordinates of the pixels of the rovers due a map update (pitch and roll near
+    #-- zero and map_update_due), with the pose of each pixel's rover (the same float32 math as
+    #-- WorldProjector). Rovers whose cells are in their map_cache skip the projection
+    allowed = np.flatnonzero(map_update_allowed(batch.roll, batch.pitch, batch.roll_max, batch.pitch_max))
+    allowed = _map_update_due(batch, allowed)
+    misses = {} # Cache keys of the rovers whose cells are not cached
+    if len(allowed):
+        counts = [np.count_nonzero(mask[allowed], axis=1) for mask in masks]
+        project = []
+        for k, i in enumerate(allowed):
+            cache = batch.map_caches[i]
+            if cache is None:
+                project.append(i)
+                continue
+            key = cache.key(batch.pos[i], batch.yaw[i], batch.pitch[i], batch.roll[i],
+                            (counts[2][k], counts[0][k], counts[1][k], batch.worldmaps[i].cells_per_meter, 1, None))
+            cells = cache.get(key)
+            if cells is None:
+                misses[i] = key
+                project.append(i)
+            else:
+                _update_rover_map(batch, i, cells)
+        allowed = np.array(project, dtype=np.intp)
+    if len(allowed):
+        grid = get_rover_grid(batch.shape)
+        cells_per_meter = np.array([batch.worldmaps[i].cells_per_meter for i in allowed])
+        scale = PIXELS_PER_METER / cells_per_meter
+        yaw_rad = batch.yaw[allowed] * np.pi / 180
+        cos_yaw = (np.cos(yaw_rad) / scale).astype(np.float32)
+        sin_yaw = (np.sin(yaw_rad) / scale).astype(np.float32)
+        xpos = (batch.pos[allowed, 0] * cells_per_meter).astype(np.float32)
+        ypos = (batch.pos[allowed, 1] * cells_per_meter).astype(np.float32)
+        starts = np.arange(len(allowed) + 1) * pixels
+        world = []
+        for mask in masks:
+            if len(allowed) < n:
+                mask = mask[allowed]
+            #-- Rovers are contiguous in the flat indices, so pixels bounds[k]:bounds[k + 1]
+            #-- belong to the k-th allowed rover. The indices are then made relative to each
+            #-- image to look up the rover-centric coordinates in the per-pixel table
+            pix = np.flatnonzero(mask)
+            bounds = np.searchsorted(pix, starts)
+            counts = np.diff(bounds)
+            pix -= np.repeat(starts[:-1], counts)
+            x_pix, y_pix = grid.x[pix], grid.y[pix]
+            cos_pix, sin_pix = np.repeat(cos_yaw, counts), np.repeat(sin_yaw, counts)
+            x_world = x_pix * cos_pix
+            x_world -= y_pix * sin_pix
+            x_world += np.repeat(xpos, counts)
+            y_world = x_pix * sin_pix
+            y_world += y_pix * cos_pix
+            y_world += np.repeat(ypos, counts)
+            keys = cell_keys(np.floor(x_world).astype(np.intp), np.floor(y_world).astype(np.intp))
+            world.append((keys, bounds))
+
+        # 7) Update each rover's map, caching the deduplicated cells
+        (obs_keys, obs_bounds), (rock_keys, rock_bounds), (nav_keys, nav_bounds) = world
+        for k, i in enumerate(allowed):
+            cells = (np.unique(obs_keys[obs_bounds[k]:obs_bounds[k + 1]]),
+                     np.unique(rock_keys[rock_bounds[k]:rock_bounds[k + 1]]),
+                     np.unique(nav_keys[nav_bounds[k]:nav_bounds[k + 1]]))
+            if i in misses:
+                batch.map_caches[i].put(misses[i], cells)
+            _update_rover_map(batch, i, cells)
+
+    # 8) Polar coordinates, reduced to the per rover summaries used by the decision tree.
+    #-- These are weighted pixel sums, so no pixel lists are needed. Rovers are grouped
+    #-- by nav_close, which is usually the same for the whole batch
+    obs_masks, rock_masks, nav_masks = masks
+    nav_sums = np.empty((n, 4))
+    obs_sums = np.empty((n, 1))
+    rock_sums = np.empty((n, 2))
+    for nav_close in np.unique(batch.nav_close):
+        group = batch.nav_close == nav_close
+        nav_weights, obs_weights, rock_weights = get_polar_weights(batch.shape, nav_close)
+        if group.all():
+            group = slice(None)
+        nav_sums[group] = _pixel_sums(nav_masks[group], nav_weights)
+        obs_sums[group] = _pixel_sums(obs_masks[group], obs_weights)
+        rock_sums[group] = _pixel_sums(rock_masks[group], rock_weights)
+    batch.nav_count = np.rint(nav_sums[:,0]).astype(np.int64)
+    batch.nav_mean = _mean(nav_sums[:,1], batch.nav_count) * (180/np.pi)
+    batch.nav_close_count = np.rint(nav_sums[:,2]).astype(np.int64)
+    batch.nav_close_mean = _mean(nav_sums[:,3], batch.nav_close_count) * (180/np.pi)
+    batch.obs_close_count = np.rint(obs_sums[:,0]).astype(np.int64)
+    batch.rock_count = np.rint(rock_sums[:,0]).astype(np.int64)
+    batch.rock_mean = _mean(rock_sums[:,1], batch.rock_count) * (180/np.pi)
+    return batch
+
+#-- Vectorized helpers of decision.py. Each applies to the rovers selected by mask m
+def _speed_control(batch, m, speed, throttle):
+    fast = m & (batch.vel > speed + 0.1)
+    slow = m & ~fast & (batch.vel < speed)
+    cruise = m & ~fast & ~slow
+    batch.throttle[fast] = 0
+    batch.brake[fast] = batch.brake_nom[fast]
+    batch.throttle[slow] = throttle
+    batch.brake[slow] = 0
+    batch.throttle[cruise] = 0
+    batch.brake[cruise] = 0
+
+def _rover_stop(batch, m, brake_val):
+    batch.throttle[m] = 0
+    batch.brake[m] = brake_val[m]
+    batch.steer[m] = 0
+
+def _steer_dirn(batch):
+    return np.where(((batch.yaw_error + 360) % 360) < 180, 1, -1)
+
+#-- decision_step for every rover of the batch. Every mode's branch is evaluated for all
+#-- rovers in that mode at the start of the step, like the if/elif chain of decision_step
+def batch_decision_step(batch):
+    mode = batch.mode.copy()
+    vel = batch.vel
+
+    #-- 'start': save home and turn to the ideal start heading
+    m = mode == START
+    if m.any():
+        batch.target_yaw[m] = 170
+        batch.yaw_error[m] = 170 - batch.yaw[m]
+        save = m & np.isnan(batch.home[:,0])
+        batch.home[save] = batch.pos[save]
+        turn = m & ~save & (np.absolute(batch.yaw_error) > 5)
+        batch.brake[turn] = 0
+        batch.throttle[turn] = 0
+        batch.steer[turn] = (15 * _steer_dirn(batch))[turn]
+        done = m & ~save & ~turn
+        batch.steer[done] = 0
+        batch.mode[done] = FORWARD
+
+    #-- 'forward': normal driving
+    m = mode == FORWARD
+    if m.any():
+        moving = (vel >= 0.1) | (batch.throttle <= 0)
+        batch.count[m] = np.where(moving, 0, batch.count + 1)[m]
+        stuck = m & (batch.count >= 70)
+        batch.mode[stuck] = STUCK
+        _rover_stop(batch, stuck, batch.brake_set)
+        go = m & ~stuck & (batch.nav_count >= batch.stop_forward)
+        batch.throttle[go] = np.where(vel < batch.max_vel, batch.throttle_set, 0)[go]
+        batch.brake[go] = 0
+        batch.obs_stuck[go] = (batch.obs_close_count > 1)[go]
+        steer = go & (batch.nav_close_count > 0)
+        batch.steer[steer] = np.clip(batch.nav_close_mean - batch.nav_adjust, -15, 15)[steer]
+        rock = go & (batch.rock_count > 0) & (batch.rock_mean < 35)
+        _rover_stop(batch, rock, batch.brake_set)
+        target = rock & (vel == 0)
+        batch.mode[target] = VIS_TARGET
+        batch.target_yaw[target] = batch.yaw[target]
+        batch.count[target] = 0
+        done = go & (batch.sample_count >= 6)
+        batch.dist_home[done] = np.hypot(*(batch.pos - batch.home).T)[done]
+        batch.mode[done & (batch.dist_home < batch.home_prox)] = GO_HOME
+        halt = m & ~stuck & ~go
+        _rover_stop(batch, halt, batch.brake_set)
+        batch.mode[halt] = STOP
+
+    #-- 'stop': brake, then turn in place until there's enough navigable terrain
+    m = mode == STOP
+    if m.any():
+        batch.count[m] = 0
+        moving = m & (vel > 0.2)
+        _rover_stop(batch, moving, batch.brake_nom)
+        stopped = m & (vel <= 0.2)
+        turn = stopped & (batch.nav_count < batch.go_forward)
+        batch.throttle[turn] = 0
+        batch.brake[turn] = 0
+        batch.steer[turn] = 15
+        go = stopped & ~turn
+        batch.throttle[go] = batch.throttle_set[go]
+        batch.brake[go] = 0
+        batch.steer[go] = np.clip(batch.nav_mean, -15, 15)[go]
+        batch.mode[go] = FORWARD
+
+    #-- 'vis_target': drive to the visible rock sample
+    m = mode == VIS_TARGET
+    if m.any():
+        visible = m & (batch.rock_count > 0)
+        batch.target_angle[visible] = batch.rock_mean[visible]
+        turn = visible & (np.absolute(batch.target_angle) > 15)
+        _rover_stop(batch, turn & (vel > 0), batch.brake_set)
+        turn_now = turn & ~(vel > 0)
+        batch.brake[turn_now] = 0
+        batch.yaw_error[turn_now] = batch.target_angle[turn_now]
+        batch.steer[turn_now] = (15 * _steer_dirn(batch))[turn_now]
+        drive = visible & ~turn
+        _speed_control(batch, drive, 0.5, 0.3)
+        batch.steer[drive] = batch.target_angle[drive]
+        blocked = (batch.throttle > 0) & (vel < 0.1)
+        batch.count[visible] = np.where(blocked, batch.count + 1, 0)[visible]
+        push = visible & (batch.count >= 150)
+        batch.steer[push] = 0
+        batch.throttle[push] = 10
+        batch.count[push] = 0
+        lost = m & ~visible
+        batch.count1[lost] += 1
+        give_up = lost & (batch.count1 > 20)
+        batch.count1[give_up] = 0
+        batch.mode[give_up] = FORWARD
+        near = m & batch.near_sample
+        _rover_stop(batch, near, batch.brake_set)
+        batch.mode[near] = PICKUP
+        batch.count1[near] = 0
+
+    #-- 'pickup': wait for the pickup, then turn back to the saved heading
+    m = mode == PICKUP
+    if m.any():
+        _rover_stop(batch, m & batch.near_sample, batch.brake_set)
+        picked = m & ~batch.near_sample
+        batch.brake[picked] = 0
+        batch.yaw_error[picked] = (batch.target_yaw - batch.yaw)[picked]
+        turn = picked & (np.absolute(batch.yaw_error) > 5)
+        batch.steer[turn] = (15 * _steer_dirn(batch))[turn]
+        done = picked & ~turn
+        batch.sample_count[done] += 1
+        batch.mode[done] = FORWARD
+
+    #-- 'stuck': turn towards navigable terrain, then try driving again
+    m = mode == STUCK
+    if m.any():
+        first = m & ~batch.stuck
+        batch.stuck[first] = True
+        batch.count[first] = 0
+        batch.throttle[first] = 0
+        batch.yaw_error[first] = np.where(np.sign(batch.nav_mean) < 0, -1, 1)[first]
+        behind = m & batch.obs_stuck
+        max_count = np.where(behind, 50, 20)
+        batch.obs_stuck[behind] = False
+        batch.yaw_error[behind] = 1
+        turn = m & (batch.count < max_count)
+        batch.steer[turn] = batch.yaw_error[turn] * 15
+        batch.brake[turn] = 0
+        batch.throttle[turn] = 0
+        batch.count[turn] += 1
+        home = m & ~turn & batch.stuck_home
+        _speed_control(batch, home, 0.5, 0.5)
+        batch.count[home] += 1
+        home_done = home & (batch.count > 120)
+        batch.stuck_home[home_done] = False
+        _rover_stop(batch, home_done, batch.brake_nom)
+        batch.count[home_done] = 0
+        batch.stuck[home_done] = False
+        batch.mode[home_done] = GO_HOME
+        retry = m & ~turn & ~home
+        batch.count[retry] = 0
+        _rover_stop(batch, retry, batch.brake_set)
+        batch.obs_stuck[retry] = False
+        batch.stuck[retry] = False
+        batch.mode[retry] = FORWARD
+
+    #-- 'go_home': head straight for home and stop there
+    m = mode == GO_HOME
+    if m.any():
+        batch.dist_home[m] = np.hypot(*(batch.pos - batch.home).T)[m]
+        delta = batch.home - batch.pos
+        batch.target_yaw[m] = ((np.arctan2(delta[:,1], delta[:,0]) * 180/np.pi) % 360)[m]
+        batch.yaw_error[m] = (batch.target_yaw - batch.yaw)[m]
+        away = m & (batch.dist_home > 1)
+        turn = away & (np.absolute(batch.yaw_error) > 10)
+        _rover_stop(batch, turn & (vel > 0), batch.brake_set)
+        turn_now = turn & ~(vel > 0)
+        batch.brake[turn_now] = 0
+        batch.throttle[turn_now] = 0
+        batch.steer[turn_now] = (15 * _steer_dirn(batch))[turn_now]
+        drive = away & ~turn
+        _speed_control(batch, drive, 1.0, 0.2)
+        batch.steer[drive] = (np.absolute(batch.yaw_error) * _steer_dirn(batch))[drive]
+        batch.count[drive] = np.where(vel < 0.1, batch.count + 1, 0)[drive]
+        stuck = drive & (batch.count >= 50)
+        batch.mode[stuck] = STUCK
+        batch.stuck_home[stuck] = True
+        _rover_stop(batch, stuck, batch.brake_set)
+        _rover_stop(batch, m & ~away, batch.brake_set)
+
+    # If in a state where want to pickup a rock send pickup command
+    batch.send_pickup |= batch.near_sample & (vel == 0) & ~batch.picking_up
+    return batch
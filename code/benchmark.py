@@ -0,0 +1,276 @@
+#-- Perception benchmark on a recorded run (default: the test dataset).
+#-- The log and all its images are loaded into memory once. Then:
+#--  * every perception function (the reference color_thresh / rover_coords / pix_to_world
+#--    versions and the table driven versions used by perception_step) is timed per frame,
+#--  * perception_step (and decision_step) are run over the whole run for frames/s,
+#--  * allocations per frame are measured with tracemalloc,
+#--  * the outputs of the fast paths are checked against the reference functions, and a
+#--    digest of the final world map is compared with the baseline.
+#-- Results can be saved as a baseline JSON and later runs compared against it. The exit
+#-- status is 1 if an output check fails or the map differs from the baseline.
+#--
+#-- Example: $ python benchmark.py --save ../output/baseline.json
+#--          $ python benchmark.py --baseline ../output/baseline.json
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from perception import (perception_step, color_thresh, rover_coords, to_polar_coords, pix_to_world,
+                        perspect_transform, calibration_points, get_warp_engine, get_color_classifier,
+                        get_rover_grid, get_world_projector, NAV_THRESH, OBS_THRESH, ROCK_THRESH,
+                        PIXELS_PER_METER)
+from decision import decision_step
+from supporting_functions import render_output_images, create_output_images
+from rover_state import RoverState
+from replay import read_log, read_image, resolve_image_path, update_rover_from_log
+
+#-- World size of the reference pix_to_world projection
+WORLD_SIZE = 200
+#-- Largest fraction of warped pixels allowed to differ from cv2.warpPerspective.
+#-- cv2.remap rounds the interpolation weights slightly differently
+WARP_TOLERANCE = 0.01
+#-- Largest fraction of all projected pixels allowed to land in a different world cell
+#-- than with pix_to_world (float32 vs float64 rounding at cell edges)
+PROJECT_TOLERANCE = 0.001
+
+#-- Load every frame of a log: a list of (row, image)
+def load_frames(log_file, limit=0):
+    log_dir = os.path.dirname(os.path.abspath(log_file))
+    frames = []
+    for row in read_log(log_file):
+        frames.append((row, read_image(resolve_image_path(row['Path'], log_dir))))
+        if limit and len(frames) >= limit:
+            break
+    return frames
+
+#-- Time fn(arg) for every arg, `repeat` times. Returns per-call statistics in microseconds
+def time_calls(fn, args, repeat=3):
+    times = np.empty((repeat, len(args)))
+    for r in range(repeat):
+        for i, arg in enumerate(args):
+            t0 = time.perf_counter()
+            fn(arg)
+            times[r, i] = time.perf_counter() - t0
+    # Best of the repeats for every call, to filter out scheduling noise
+    best = times.min(axis=0) * 1e6
+    return {'mean_us': float(best.mean()), 'p50_us': float(np.median(best)),
+            'p95_us': float(np.percentile(best, 95)), 'calls_per_s': float(1e6 / best.mean())}
+
+#-- Inputs of the per-function benchmarks, computed once per frame
+def prepare_inputs(frames):
+    source, destination = calibration_points(frames[0][1].shape)
+    inputs = []
+    for row, img in frames:
+        warped = perspect_transform(img, source, destination)
+        masks = [color_thresh(warped, *thresh) for thresh in (NAV_THRESH, OBS_THRESH, ROCK_THRESH)]
+        pixels = [rover_coords(mask) for mask in masks]
+        pose = (float(row['X_Position'].replace(',', '.')), float(row['Y_Position'].replace(',', '.')),
+                float(row['Yaw'].replace(',', '.')))
+        inputs.append({'img': img, 'warped': warped, 'masks': masks, 'pixels': pixels, 'pose': pose})
+    return source, destination, inputs
+
+#-- The benchmarked functions: name -> function of one prepared input
+def benchmarks(frames, source, destination):
+    shape = frames[0][1].shape
+    warp_engine = get_warp_engine(shape)
+    classifier = get_color_classifier(shape)
+    grid = get_rover_grid(shape)
+    projector = get_world_projector(WORLD_SIZE, PIXELS_PER_METER)
+
+    def reference_project(inp):
+        xpos, ypos, yaw = inp['pose']
+        return [pix_to_world(xpix, ypix, xpos, ypos, yaw, WORLD_SIZE, PIXELS_PER_METER)
+                for xpix, ypix in inp['pixels']]
+
+    def project(inp):
+        xpos, ypos, yaw = inp['pose']
+        return projector.project_indices(grid, [grid.indices(mask) for mask in inp['masks']], xpos, ypos, yaw)
+
+    return {
+        # Reference functions
+        'perspect_transform': lambda inp: perspect_transform(inp['img'], source, destination),
+        'color_thresh': lambda inp: [color_thresh(inp['warped'], *thresh)
+                                     for thresh in (NAV_THRESH, OBS_THRESH, ROCK_THRESH)],
+        'rover_coords': lambda inp: [rover_coords(mask) for mask in inp['masks']],
+        'to_polar_coords': lambda inp: to_polar_coords(*inp['pixels'][0]),
+        'pix_to_world': reference_project,
+        # Table driven functions used by perception_step
+        'WarpEngine.warp': lambda inp: warp_engine.warp(inp['img']),
+        'ColorClassifier.binary_images': lambda inp: classifier.binary_images(inp['warped']),
+        'RoverGrid.indices': lambda inp: [grid.indices(mask) for mask in inp['masks']],
+        'RoverGrid.polar': lambda inp: grid.polar(grid.indices(inp['masks'][0])),
+        'WorldProjector.project_indices': project,
+    }
+
+#-- Check the fast paths against the reference functions on every frame.
+#-- Returns {check: mismatch fraction} and the list of failed checks. The fractions are the
+#-- worst frame's, except for the projection, which is over all pixels of the run
+def check_equivalence(frames, inputs):
+    shape = frames[0][1].shape
+    warp_engine = get_warp_engine(shape)
+    classifier = get_color_classifier(shape)
+    grid = get_rover_grid(shape)
+    projector = get_world_projector(WORLD_SIZE, PIXELS_PER_METER)
+    worst = {'warp': 0.0, 'classify': 0.0, 'rover_coords': 0.0, 'polar': 0.0}
+    moved = projected = 0
+    for inp in inputs:
+        warped = warp_engine.warp(inp['img'])
+        worst['warp'] = max(worst['warp'], np.mean(np.any(warped != inp['warped'], axis=2)))
+        for mask, fast in zip(inp['masks'], classifier.binary_images(inp['warped'])):
+            worst['classify'] = max(worst['classify'], np.mean(mask != fast))
+        idx_list = [grid.indices(mask) for mask in inp['masks']]
+        for (xpix, ypix), idx in zip(inp['pixels'], idx_list):
+            x_fast, y_fast = grid.coords(idx)
+            if not (np.array_equal(xpix, x_fast) and np.array_equal(ypix, y_fast)):
+                worst['rover_coords'] = 1.0
+        dist, angles = to_polar_coords(*inp['pixels'][0])
+        dist_fast, angles_fast = grid.polar(idx_list[0])
+        if not (np.allclose(dist, dist_fast, atol=1e-3) and np.allclose(angles, angles_fast, atol=1e-5)):
+            worst['polar'] = 1.0
+        xpos, ypos, yaw = inp['pose']
+        fast = projector.project_indices(grid, idx_list, xpos, ypos, yaw)
+        for (xpix, ypix), (x_fast, y_fast) in zip(inp['pixels'], fast):
+            if len(xpix):
+                x_ref, y_ref = pix_to_world(xpix, ypix, xpos, ypos, yaw, WORLD_SIZE, PIXELS_PER_METER)
+                moved += np.count_nonzero((x_ref != x_fast) | (y_ref != y_fast))
+                projected += len(xpix)
+    worst['project'] = moved / max(projected, 1)
+    tolerance = {'warp': WARP_TOLERANCE, 'project': PROJECT_TOLERANCE}
+    failed = [name for name, value in worst.items() if value > tolerance.get(name, 0)]
+    return {name: float(value) for name, value in worst.items()}, failed
+
+#-- Run perception_step and decision_step over the whole run with one rover.
+#-- Returns the frames/s of each and the final rover
+def run_pipeline(frames, repeat=3):
+    best = None
+    for r in range(repeat):
+        Rover = RoverState()
+        Rover.total_time = 0
+        perception_time = decision_time = 0
+        for row, img in frames:
+            update_rover_from_log(Rover, row, img, None)
+            t0 = time.perf_counter()
+            perception_step(Rover)
+            t1 = time.perf_counter()
+            decision_step(Rover)
+            t2 = time.perf_counter()
+            perception_time += t1 - t0
+            decision_time += t2 - t1
+        if best is None or perception_time < best[0]:
+            best = (perception_time, decision_time)
+    return {'perception_step_fps': len(frames) / best[0],
+            'decision_step_fps': len(frames) / max(best[1], 1e-9)}, Rover
+
+#-- Output image functions, timed `calls` times on the rover at the end of the run
+def time_output_images(Rover, calls=20, repeat=3):
+    return {'render_output_images': time_calls(lambda _: render_output_images(Rover), [None] * calls, repeat),
+            'create_output_images': time_calls(lambda _: create_output_images(Rover), [None] * calls, repeat)}
+
+#-- Allocations of perception_step per frame: peak traced memory above the starting level
+#-- and the number of memory blocks still alive afterwards (per frame means)
+def measure_allocations(frames):
+    Rover = RoverState()
+    # Warm up the cached tables and buffers so only per-frame allocations are counted
+    update_rover_from_log(Rover, frames[0][0], frames[0][1], None)
+    perception_step(Rover)
+    tracemalloc.start()
+    peak = 0
+    blocks = 0
+    for row, img in frames:
+        update_rover_from_log(Rover, row, img, None)
+        before = tracemalloc.take_snapshot()
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        perception_step(Rover)
+        peak += tracemalloc.get_traced_memory()[1] - current
+        after = tracemalloc.take_snapshot()
+        blocks += sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    tracemalloc.stop()
+    return {'peak_kb_per_frame': peak / len(frames) / 1024, 'new_blocks_per_frame': blocks / len(frames)}
+
+#-- Digest of the world map and map statistics at the end of the run
+def map_digest(Rover):
+    rows, cols = Rover.ground_truth.shape[:2]
+    cells_per_meter = Rover.worldmap.cells_per_meter
+    rgb = Rover.worldmap.as_rgb(0, 0, rows * cells_per_meter, cols * cells_per_meter)
+    digest = hashlib.sha1(rgb.tobytes())
+    digest.update('{} {}'.format(Rover.map_stats.perc_mapped(), Rover.map_stats.fidelity()).encode())
+    return digest.hexdigest()
+
+def run_benchmark(log_file, limit=0, repeat=3):
+    t0 = time.perf_counter()
+    frames = load_frames(log_file, limit)
+    print('Loaded {} frames in {:.1f} s'.format(len(frames), time.perf_counter() - t0))
+    source, destination, inputs = prepare_inputs(frames)
+    results = {'frames': len(frames), 'functions': {}}
+    for name, fn in benchmarks(frames, source, destination).items():
+        results['functions'][name] = time_calls(fn, inputs, repeat)
+    results['pipeline'], Rover = run_pipeline(frames, repeat)
+    results['functions'].update(time_output_images(Rover, repeat=repeat))
+    results['allocations'] = measure_allocations(frames)
+    results['equivalence'], failed = check_equivalence(frames, inputs)
+    results['failed'] = failed
+    results['map_digest'] = map_digest(Rover)
+    results['mapped'] = Rover.map_stats.perc_mapped()
+    results['fidelity'] = Rover.map_stats.fidelity()
+    return results
+
+#-- Print the results, with the change against the baseline where there is one
+def print_results(results, baseline=None):
+    base_functions = baseline['functions'] if baseline else {}
+    print('{:<32}{:>12}{:>12}{:>12}{:>10}'.format('function', 'mean (us)', 'p95 (us)', 'calls/s', 'speedup'))
+    for name, stats in results['functions'].items():
+        base = base_functions.get(name)
+        speedup = '{:.2f}x'.format(base['mean_us'] / stats['mean_us']) if base else ''
+        print('{:<32}{:>12.1f}{:>12.1f}{:>12.0f}{:>10}'.format(name, stats['mean_us'], stats['p95_us'],
+                                                              stats['calls_per_s'], speedup))
+    for name, value in results['pipeline'].items():
+        base = baseline['pipeline'].get(name) if baseline else None
+        speedup = ' ({:.2f}x)'.format(value / base) if base else ''
+        print('{}: {:.1f}{}'.format(name, value, speedup))
+    for name, value in results['allocations'].items():
+        base = baseline['allocations'].get(name) if baseline else None
+        change = ' (baseline {:.1f})'.format(base) if base is not None else ''
+        print('{}: {:.1f}{}'.format(name, value, change))
+    print('Mapped: {}% Fidelity: {}%'.format(results['mapped'], results['fidelity']))
+    print('Mismatch vs reference: ' + ', '.join('{} {:.4%}'.format(name, value)
+                                                     for name, value in results['equivalence'].items()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the perception pipeline on a recorded run')
+    parser.add_argument('log_file', type=str, nargs='?', default='../test_dataset/robot_log.csv',
+                        help='Path to the robot_log.csv of the run.')
+    parser.add_argument('--limit', type=int, default=0, help='Only use the first N frames.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repeats (the best is kept).')
+    parser.add_argument('--save', type=str, default='', help='Save the results as a baseline JSON.')
+    parser.add_argument('--baseline', type=str, default='', help='Compare against a saved baseline JSON.')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.log_file, args.limit, args.repeat)
+    baseline = None
+    if args.baseline != '':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    status = 0
+    if results['failed']:
+        print('FAILED output checks: ' + ', '.join(results['failed']))
+        status = 1
+    if baseline is not None:
+        if baseline['frames'] != results['frames']:
+            print('Baseline was recorded on {} frames, not comparing the map'.format(baseline['frames']))
+        elif baseline['map_digest'] != results['map_digest']:
+            print('FAILED: the world map differs from the baseline')
+            status = 1
+    if args.save != '':
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved baseline to {}'.format(args.save))
+    sys.exit(status)
@@ -1,5 +1,8 @@
 import numpy as np
 
+from planner import HomePlanner
+from rover_state import Mode
+
 #-- Function to control the speed of the rover about the desired speed at given throttle
 def speed_control(Rover, speed, throttle):
     if Rover.vel > speed + 0.1:
@@ -42,11 +45,17 @@ def decision_step(Rover):
     # Here you're all set up with some basic functionality but you'll need to
     # improve on this decision tree to do a good job of navigating autonomously!
 
+    #-- Pixel counts are in full resolution pixels, whatever resolution perception ran at.
+    #-- With Rover.perception_range the terrain beyond the range isn't counted, so the rover
+    #-- stops and turns in open terrain more readily (see perception.check_perception_range).
+    #-- Polar coordinates are only computed for the views and distance bands read below
+    nav_count = Rover.nav_view.count()
+
     # Check for Rover.mode status
     # Rover
     #-- Start mode used to save initial position.
     #-- Point rover in ideal start heading then transition to 'forward'
-    if Rover.mode == 'start':
+    if Rover.mode == Mode.START:
         Rover.target_yaw = 170
         Rover.yaw_error = (Rover.target_yaw - Rover.yaw)
         #-- Save home position
@@ -59,10 +68,10 @@ def decision_step(Rover):
             Rover.steer = 15 * steer_dirn(Rover)
         else:
             Rover.steer = 0
-            Rover.mode = 'forward'
+            Rover.mode = Mode.FORWARD
     
     #-- Normal driving state of the rover.
-    elif Rover.mode == 'forward': 
+    elif Rover.mode == Mode.FORWARD: 
         #-- Crude check to determine if the rover is stuck
         #-- If the rover is in 'forward' mode but the velocity stays < 0.1 for
         #-- more than 50 cycles, assume stuck
@@ -72,10 +81,10 @@ def decision_step(Rover):
             Rover.count = 0
             
         if Rover.count >= 70:
-            Rover.mode = 'stuck'
+            Rover.mode = Mode.STUCK
             rover_stop(Rover, Rover.brake_set)
             
-        elif len(Rover.nav_angles) >= Rover.stop_forward:
+        elif nav_count >= Rover.stop_forward:
             # If mode is forward, navigable terrain looks good 
             # and velocity is below max, then throttle 
             if Rover.vel < Rover.max_vel:
@@ -87,28 +96,39 @@ def decision_step(Rover):
             
             #-- Check for obstacles directly in front of rover.
             #-- This helps to determine if rover is stuck behind an obstacle
-            if (len(Rover.obs_dists[Rover.obs_dists < 10]) > 1):
+            if (Rover.obs_view.count(10) > 1):
                 Rover.obs_stuck = True
             else:
                 Rover.obs_stuck = False
             
             #-- Determine angle to steer.
             #-- Only consider the area directly in front of the rover.
-            angles = Rover.nav_angles[(Rover.nav_dists < Rover.nav_close)]
             #-- catch error when no terrain pixels in image
-            #-- offset steering angle by x degrees to make the rover hug the wall.
-            if (len(angles) > 0):
-                Rover.steer = np.clip((np.mean(angles * 180/np.pi) - Rover.nav_adjust), -15, 15)
+            #-- Steer towards the selected frontier of the worldmap, limited to the spread of the
+            #-- navigable terrain ahead so the rover stays off the walls.
+            #-- Without a frontier ahead, offset steering angle by x degrees to make the rover hug the wall.
+            if (Rover.nav_view.count(Rover.nav_close) > 0):
+                Rover.frontier_target = None
+                if Rover.explore_frontiers:
+                    Rover.frontier_target = Rover.frontiers.select(Rover.pos, Rover.yaw)
+                if Rover.frontier_target is not None:
+                    angles = Rover.nav_view.angles(Rover.nav_close) * 180/np.pi
+                    frontier_yaw = np.arctan2(Rover.frontier_target[1] - Rover.pos[1], Rover.frontier_target[0] - Rover.pos[0]) *180/np.pi
+                    frontier_angle = (frontier_yaw - Rover.yaw + 180) % 360 - 180
+                    low, high = np.percentile(angles, (10, 90))
+                    Rover.steer = np.clip(np.clip(frontier_angle, low, high), -15, 15)
+                else:
+                    Rover.steer = np.clip((Rover.nav_view.mean_angle(Rover.nav_close) - Rover.nav_adjust), -15, 15)
             
             #-- If a rock is visible in the image, transition to 'vis_target' mode
             #-- Save current yaw heading to continue in the same direction after picking up the sample
             #-- This helps to ensure most of the map is explored
-            if (len(Rover.rock_angles) > 0):
-                rock_angle = np.mean(Rover.rock_angles * 180/np.pi)
+            if (len(Rover.rock_view) > 0):
+                rock_angle = Rover.rock_view.mean_angle()
                 if rock_angle < 35:
                     rover_stop(Rover, Rover.brake_set)
                     if Rover.vel == 0:
-                        Rover.mode = 'vis_target'
+                        Rover.mode = Mode.VIS_TARGET
                         Rover.target_yaw = Rover.yaw
                         Rover.count = 0
             
@@ -118,17 +138,17 @@ def decision_step(Rover):
             if (Rover.sample_count >= 6):
                 Rover.dist_home = np.sqrt((Rover.pos[0]-Rover.home[0])**2 + (Rover.pos[1]-Rover.home[1])**2)
                 if (Rover.dist_home < Rover.home_prox):
-                    Rover.mode = 'go_home'    
+                    Rover.mode = Mode.GO_HOME    
         
         # If there's a lack of navigable terrain pixels then go to 'stop' mode
-        elif len(Rover.nav_angles) < Rover.stop_forward:
+        elif nav_count < Rover.stop_forward:
                 # Set mode to "stop" and hit the brakes!
                 # Set brake to stored brake value
                 rover_stop(Rover, Rover.brake_set)
-                Rover.mode = 'stop'
+                Rover.mode = Mode.STOP
 
     # If we're already in "stop" mode then make different decisions
-    elif Rover.mode == 'stop':
+    elif Rover.mode == Mode.STOP:
         #-- reset stuck counter
         Rover.count = 0
         # If we're in stop mode but still moving keep braking
@@ -138,28 +158,28 @@ def decision_step(Rover):
         # If we're not moving (vel < 0.2) then do something else
         elif Rover.vel <= 0.2:
             # Now we're stopped and we have vision data to see if there's a path forward
-            if len(Rover.nav_angles) < Rover.go_forward:
+            if nav_count < Rover.go_forward:
                 Rover.throttle = 0
                 # Release the brake to allow turning
                 Rover.brake = 0
                 # Turn range is +/- 15 degrees, when stopped the next line will induce 4-wheel turning
                 Rover.steer = 15 # Turn left since the rover is following the right wall
             # If we're stopped but see sufficient navigable terrain in front then go!
-            if len(Rover.nav_angles) >= Rover.go_forward:
+            if nav_count >= Rover.go_forward:
                 # Set throttle back to stored value
                 Rover.throttle = Rover.throttle_set
                 # Release the brake
                 Rover.brake = 0
                 # Set steer to mean angle
-                Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
-                Rover.mode = 'forward'
+                Rover.steer = np.clip(Rover.nav_view.mean_angle(), -15, 15)
+                Rover.mode = Mode.FORWARD
     
     #-- In this mode, the sample is visible in the Rover's vision image and it is driving towards the sample
-    elif Rover.mode == 'vis_target':
+    elif Rover.mode == Mode.VIS_TARGET:
         
         #-- If sample is still visible, navigate towards it
-        if (len(Rover.rock_angles) > 0):
-            Rover.target_angle = np.mean(Rover.rock_angles * 180/np.pi)
+        if (len(Rover.rock_view) > 0):
+            Rover.target_angle = Rover.rock_view.mean_angle()
             #-- If sample is more than 15 degrees away, 4 wheel turn
             #-- Otherwise drive to sample
             if np.absolute(Rover.target_angle) > 15:
@@ -188,15 +208,15 @@ def decision_step(Rover):
             Rover.count1 += 1
             if Rover.count1 > 20:
                 Rover.count1 = 0
-                Rover.mode = 'forward'
+                Rover.mode = Mode.FORWARD
         #-- If in range to pick up sample, hit the brakes and transition to 'pickup' state
         if (Rover.near_sample):
             rover_stop(Rover, Rover.brake_set)
-            Rover.mode = 'pickup'
+            Rover.mode = Mode.PICKUP
             Rover.count1 = 0
     
     #-- In pickup state, stop and wait for rover to pick up sample. This is done automatically    
-    elif Rover.mode == 'pickup':
+    elif Rover.mode == Mode.PICKUP:
         if Rover.near_sample:
             rover_stop(Rover, Rover.brake_set)
         #-- Once sample is picked up, near_sample flag is cleared. Rover turns back to original heading
@@ -208,19 +228,19 @@ def decision_step(Rover):
                 Rover.steer = 15 * steer_dirn(Rover)
             else:
                 Rover.sample_count += 1
-                Rover.mode = 'forward'
+                Rover.mode = Mode.FORWARD
     
     #-- In this mode, the rover has determined that it is stuck.
     #-- Procedure to free itself could be improved significantly.
     #-- However, this seems to work for most cases even if it takes a bit longer
-    elif Rover.mode == 'stuck':
+    elif Rover.mode == Mode.STUCK:
         #-- Check if 'stuck' flag not set (first stuck cycle)
         #-- determine best direction to steer out of stuck position (towards most navigable terrain)
         if not Rover.stuck:
             Rover.stuck = True
             Rover.count = 0
             Rover.throttle = 0
-            if np.sign(np.mean(Rover.nav_angles * 180/np.pi)) < 0:
+            if np.sign(Rover.nav_view.mean_angle()) < 0:
                 Rover.yaw_error = -1
             else:
                 Rover.yaw_error = 1
@@ -246,21 +266,29 @@ def decision_step(Rover):
                 rover_stop(Rover, Rover.brake_nom)
                 Rover.count = 0
                 Rover.stuck = False
-                Rover.mode = 'go_home'
+                Rover.mode = Mode.GO_HOME
         else:
             Rover.count = 0
             rover_stop(Rover, Rover.brake_set)
-            Rover.stuck_obs = False
+            Rover.obs_stuck = False
             Rover.stuck = False
-            Rover.mode = 'forward'
+            Rover.mode = Mode.FORWARD
     
     #-- In this mode, the rover returns to the start position.
     #-- Entered once all the samples have been collected and the rover is in close proximity of home
-    elif Rover.mode == 'go_home':
+    elif Rover.mode == Mode.GO_HOME:
         
-        #-- Update distance to home and calculate direction to home
+        #-- Plan a route home over the worldmap. The planner caches its distance field and
+        #-- only replans when the map changes near the route
+        if Rover.home_planner is None:
+            Rover.home_planner = HomePlanner(Rover.worldmap, Rover.home)
+        #-- Head for the next waypoint on the route, or straight home if there's no route
+        target = Rover.home_planner.waypoint(Rover.pos)
+        if target is None:
+            target = Rover.home
+        #-- Update distance to home and calculate direction to the target
         Rover.dist_home = np.sqrt((Rover.pos[0]-Rover.home[0])**2 + (Rover.pos[1]-Rover.home[1])**2)
-        Rover.target_yaw = (np.arctan2(Rover.home[1] - Rover.pos[1], Rover.home[0] - Rover.pos[0]) *180/np.pi) %360
+        Rover.target_yaw = (np.arctan2(target[1] - Rover.pos[1], target[0] - Rover.pos[0]) *180/np.pi) %360
         Rover.yaw_error = (Rover.target_yaw - Rover.yaw)# % 360
         
         #-- not home yet
@@ -288,7 +316,7 @@ def decision_step(Rover):
                     Rover.count = 0
                     
                 if Rover.count >= 50:
-                    Rover.mode = 'stuck'
+                    Rover.mode = Mode.STUCK
                     Rover.stuck_home = True
                     rover_stop(Rover, Rover.brake_set)
                             
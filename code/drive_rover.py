@@ -14,92 +14,23 @@ from flask import Flask
 from io import BytesIO, StringIO
 import json
 import pickle
-import matplotlib.image as mpimg
 import time
+import atexit
 
 # Import functions for perception and decision making
-from perception import perception_step
+from perception import perception_step, check_perception_range, min_perception_range
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from supporting_functions import update_rover, create_output_images, render_output_images, InsetEncoder
+from supporting_functions import telemetry_decoder
+from rover_state import RoverState
+from profiling import StageProfiler
+from framestore import FrameStoreWriter
+from pipeline import PerceptionWorker
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = [] # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = 'start' # Current mode (can be forward or stop)
-        self.throttle_set = 0.3 # Throttle setting when accelerating
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.stop_forward = 50 # Threshold to initiate stopping
-        self.go_forward = 500 # Threshold to go forward again
-        self.max_vel = 1.5 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float)       
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_found = 0 # To count the number of samples found
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-        
-        self.count = 0 #-- General purpose counter
-        self.count1 = 0 #-- General purpose counter
-        self.rock_dists = None #-- Distances of rock sample pixels
-        self.rock_angles = None #-- Angles of rock sample pixels
-        self.obs_dists = None #-- Distances of obstacle pixels
-        self.obs_angles = None #-- Angles of obstacle pixels
-        self.stuck = False #-- Stuck flag
-        self.stuck_home = False #-- Stuck flag in go_home state
-        self.yaw_error = 0 #-- Holds the error between current and desired yaw angle
-        self.nav_adjust = 13.0 #-- Navigation offset angle to hug the right wall (13 works well)
-        self.pitch_max = 0.2 #-- Maximum pitch for updating worldmap
-        self.roll_max = 0.5 #-- Maximum roll for updating worldmap
-        self.home = None #-- Hold the home position of the rover
-        self.sample_count = 0 #-- Keep track of the number of samples collected
-        self.target_yaw = 0 #-- Holds the desired yaw angle
-        self.brake_nom = 0.5 #-- Nominal brake value
-        self.dist_home = 0 #-- Distance to home position
-        self.nav_close = 40 #-- The distance from the rover that is looked at when determining steering angle
-        self.home_prox = 11 #-- Proximity to home location at which to transition to go_home state
-        self.target_angle = 0 #-- angle to the rock sample
-        self.obs_stuck = False #-- Flag if stuck directly behind an obstacle
-        self.debug = False #-- debug flag. Set to True to display debug telemetry to console
-        
 # Initialize our rover 
 Rover = RoverState()
 
@@ -110,66 +41,122 @@ frame_counter = 0
 second_counter = time.time()
 fps = None
 
+#-- Encodes output images off the control path. None to encode synchronously on every frame
+inset_encoder = None
+
+#-- Records frames and telemetry to a frame store (--capture). None when not capturing
+capture = None
+
+#-- Runs perception and decision on a worker thread (--pipeline). None to run them in the handler
+perception_worker = None
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
 
-    global frame_counter, second_counter, fps
+    global frame_counter, second_counter, fps, Rover
     frame_counter+=1
     # Do a rough calculation of frames per second (FPS)
+    #-- Printed once per second, not on every frame
     if (time.time() - second_counter) > 1:
         fps = frame_counter
         frame_counter = 0
         second_counter = time.time()
+        if perception_worker is not None:
+            print("Current FPS: {} (skipped {} of {} frames)".format(fps, perception_worker.skipped,
+                                                                  perception_worker.received))
+        elif not Rover.debug:
+            print("Current FPS: {}".format(fps))
 
     if data:
-        global Rover
         
         #-- If displaying debug information, format to allow to display on one line
         if Rover.debug:
             print("Current FPS: {} ".format(fps), end = '')
-        else:
-            print("Current FPS: {}".format(fps))
+        
+        #-- Stage timing (--profile). A no-op with the default profiler
+        profiler = Rover.profiler
+        frame_start = t = profiler.tic()
+        
+        #-- Pipelined mode: queue the event for the worker and answer with the latest decision
+        if perception_worker is not None:
+            perception_worker.submit(data)
+            commands, (out_image_string1, out_image_string2) = perception_worker.latest()
+            send_control(commands, out_image_string1, out_image_string2)
+            if perception_worker.take_pickup():
+                send_pickup()
+            profiler.toc('control', frame_start)
+            if profiler.due():
+                print(profiler.report())
+            return
         
         # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+        Rover, jpeg = update_rover(Rover, data)
+        t = profiler.toc('decode', t)
 
         if np.isfinite(Rover.vel):
 
             # Execute the perception and decision steps to update the Rover's state
             Rover = perception_step(Rover)
+            t = profiler.toc('perception', t)
             Rover = decision_step(Rover)
-
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
+            t = profiler.toc('decision', t)
 
             # The action step!  Send commands to the rover!
+            #-- Commands go out first, along with the most recently encoded output images
             commands = (Rover.throttle, Rover.brake, Rover.steer)
+            if inset_encoder is None:
+                out_image_string1, out_image_string2 = create_output_images(Rover)
+            else:
+                out_image_string1, out_image_string2 = inset_encoder.latest()
+            t = profiler.toc('output_images', t)
             send_control(commands, out_image_string1, out_image_string2)
+            t = profiler.toc('send_control', t)
  
             # If in a state where want to pickup a rock send pickup command
             if Rover.send_pickup and not Rover.picking_up:
                 send_pickup()
                 # Reset Rover flags
                 Rover.send_pickup = False
+
+            #-- Create output images to send to server. They are encoded on the encoder
+            #-- thread and sent with the commands of a following frame
+            if inset_encoder is not None and inset_encoder.due():
+                inset_encoder.submit(*render_output_images(Rover))
+                t = profiler.toc('render', t)
         # In case of invalid telemetry, send null commands
         else:
 
             # Send zeros for throttle, brake and steer and empty images
             send_control((0, 0, 0), '', '')
 
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+        record_frame(Rover, jpeg)
+        t = profiler.toc('record', t)
+        
+        profiler.toc('frame', frame_start)
+        if profiler.due():
+            print(profiler.report())
 
     else:
         sio.emit('manual', data={}, skip_sid=True)
 
+#-- Save the camera image (image_folder) and queue the frame to the frame store (--capture)
+def record_frame(Rover, jpeg):
+    # If you want to save camera images from autonomous driving specify a path
+    # Example: $ python drive_rover.py image_folder_path
+    # Conditional to save image frame if folder was specified
+    if args.image_folder != '':
+        timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+        image_filename = os.path.join(args.image_folder, timestamp)
+        #-- The camera image is already a JPEG, so write it out as received
+        with open('{}.jpg'.format(image_filename), 'wb') as image_file:
+            image_file.write(jpeg)
+    #-- Queue the raw frame and telemetry to the frame store writer thread
+    if capture is not None:
+        if capture.samples is None:
+            capture.samples = Rover.samples_pos
+        capture.append(telemetry_decoder.telemetry)
+
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
@@ -213,8 +200,112 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--inset_every',
+        type=int,
+        default=1,
+        help='Render and encode the output images every N frames on a worker thread. 0 encodes them synchronously on every frame.'
+    )
+    parser.add_argument(
+        '--inset_period',
+        type=float,
+        default=0,
+        help='Minimum time in seconds between output image updates.'
+    )
+    parser.add_argument(
+        '--profile',
+        type=float,
+        default=None,
+        metavar='PERIOD',
+        help='Time each processing stage and print latency percentiles every PERIOD seconds (0 only on exit).'
+    )
+    parser.add_argument(
+        '--profile_file',
+        type=str,
+        default='',
+        help='Also write the latency percentiles to this JSON file on exit (with --profile).'
+    )
+    parser.add_argument(
+        '--capture',
+        type=str,
+        default='',
+        help='Record raw frames and telemetry to a memory-mapped frame store in this folder, for replay.py.'
+    )
+    parser.add_argument(
+        '--capture_frames',
+        type=int,
+        default=20000,
+        help='Number of frames preallocated in the frame store (about 150 kB each).'
+    )
+    parser.add_argument(
+        '--perception_scale',
+        type=int,
+        default=1,
+        choices=(1, 2, 4),
+        help='Run perception at 1/N resolution. Faster, with a coarser map.'
+    )
+    parser.add_argument(
+        '--perception_range',
+        type=float,
+        default=None,
+        help='Only perceive terrain within this many meters of the rover (at least {:g}). Faster, but the rover '
+             'stops and turns more readily.'.format(min_perception_range(Rover))
+    )
+    parser.add_argument(
+        '--cells_per_meter',
+        type=int,
+        default=1,
+        help='World map resolution in cells per meter.'
+    )
+    parser.add_argument(
+        '--map_max_skip',
+        type=int,
+        default=0,
+        help='Skip world map updates for up to N frames while the pose barely changes (0 never skips). '
+             'Faster, with a slightly smaller map.'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Run perception and decision on a worker thread on the newest frame only, and answer '
+             'every telemetry event straight away with the latest decision.'
+    )
     args = parser.parse_args()
     
+    Rover = RoverState(args.cells_per_meter)
+    Rover.map_max_skip = args.map_max_skip
+    
+    if args.profile is not None:
+        Rover.profiler = StageProfiler(period=args.profile)
+        #-- Final report on exit
+        def report_profile():
+            print(Rover.profiler.report())
+            if args.profile_file != '':
+                Rover.profiler.dump(args.profile_file)
+        atexit.register(report_profile)
+    
+    if args.inset_every > 0:
+        inset_encoder = InsetEncoder(args.inset_every, args.inset_period)
+    
+    if args.capture != '':
+        capture = FrameStoreWriter(args.capture, args.capture_frames)
+        print("Capturing this run to {} ...".format(args.capture))
+        #-- Write out the queued frames and the frame count on exit
+        def close_capture():
+            capture.close()
+            print("Captured {} frames ({} dropped)".format(capture.count, capture.dropped))
+        atexit.register(close_capture)
+    
+    Rover.perception_scale = args.perception_scale
+    Rover.perception_range = args.perception_range
+    try:
+        check_perception_range(Rover)
+    except ValueError as error:
+        parser.error(error)
+    
+    if args.pipeline:
+        perception_worker = PerceptionWorker(Rover, inset_encoder, record_frame)
+    
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
         print("Creating image folder at {}".format(args.image_folder))
@@ -224,7 +315,7 @@ if __name__ == '__main__':
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
         print("Recording this run ...")
-    else:
+    elif capture is None:
         print("NOT recording this run ...")
     
     # wrap Flask application with socketio's middleware
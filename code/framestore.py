@@ -0,0 +1,149 @@
+#-- Record-and-replay capture of telemetry into a memory-mapped frame store.
+#-- A store is a folder holding:
+#--   frames.bin  - `capacity` fixed-size slots of raw RGB uint8 camera frames
+#--   index.bin   - a structured array with one row of telemetry per slot (INDEX_DTYPE)
+#--   meta.json   - frame shape, capacity, frame count and the sample positions of the run
+#-- Both binary files are preallocated when the store is created, so recording never grows
+#-- a file. FrameStoreWriter copies frames into the slots on a background thread, so the
+#-- control loop only pays for one frame copy and a queue put. FrameStoreReader maps the
+#-- files read-only: frames and telemetry are views into the page cache, with no decoding,
+#-- and can be read in any order.
+#--
+#-- Example: $ python drive_rover.py --capture ../output/capture
+#--          $ python replay.py ../output/capture ../output/replay
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from supporting_functions import TELEMETRY_FLOATS, TELEMETRY_INTS
+
+FRAMES_FILE = 'frames.bin'
+INDEX_FILE = 'index.bin'
+META_FILE = 'meta.json'
+
+#-- One index row per frame: capture time, then the telemetry fields keyed as by TelemetryDecoder.decode
+INDEX_DTYPE = np.dtype([('time', '<f8')] + [(name, '<f8') for key, name in TELEMETRY_FLOATS]
+                       + [('pos', '<f8', (2,))] + [(name, '<i4') for key, name in TELEMETRY_INTS])
+
+#-- True if path is a frame store folder
+def is_frame_store(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+def _write_meta(path, meta):
+    tmp_path = os.path.join(path, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+
+#-- Appends frames and telemetry to a new frame store at path.
+#-- Frames are queued to the writer thread; if it falls `queue_size` frames behind, or the
+#-- store is full, frames are dropped and counted instead of blocking the caller
+class FrameStoreWriter():
+    def __init__(self, path, capacity=20000, shape=(160, 320, 3), queue_size=64):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.count = 0 # Slots handed out to queued frames
+        self.dropped = 0 # Frames dropped because the store was full or the writer was behind
+        self.samples = None # Sample positions of the run, saved in meta.json
+        self.frames = np.memmap(os.path.join(path, FRAMES_FILE), dtype=np.uint8, mode='w+',
+                                shape=(capacity,) + self.shape)
+        self.index = np.memmap(os.path.join(path, INDEX_FILE), dtype=INDEX_DTYPE, mode='w+',
+                               shape=(capacity,))
+        self._write_meta(closed=False)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='FrameStoreWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    #-- Queue a frame. telemetry is a dict as returned by TelemetryDecoder.decode.
+    #-- Returns False if the frame was dropped
+    def append(self, telemetry, timestamp=None):
+        img = telemetry["img"]
+        if img.shape != self.shape:
+            raise ValueError('Frame shape {} does not match the store shape {}'.format(img.shape, self.shape))
+        if self.count >= self.capacity:
+            self.dropped += 1
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+        row = ((timestamp,) + tuple(telemetry[name] for key, name in TELEMETRY_FLOATS)
+               + (telemetry["pos"],) + tuple(telemetry[name] for key, name in TELEMETRY_INTS))
+        try:
+            #-- The decoder reuses its image buffer, so hand the writer a copy
+            self._queue.put_nowait((self.count, row, img.copy()))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.count += 1
+        return True
+
+    #-- Wait for queued frames to be written, flush the files and write the final meta.json
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self.frames.flush()
+        self.index.flush()
+        self._write_meta(closed=True)
+
+    def _write_meta(self, closed):
+        samples = None
+        if self.samples is not None:
+            samples = [np.asarray(s).tolist() for s in self.samples]
+        _write_meta(self.path, {'capacity': self.capacity, 'shape': list(self.shape),
+                                'index_dtype': INDEX_DTYPE.descr, 'count': self.count,
+                                'dropped': self.dropped, 'samples': samples, 'closed': closed})
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            slot, row, img = item
+            self.frames[slot] = img
+            self.index[slot] = row
+
+#-- Read-only view of a frame store. store[i] returns the telemetry dict of frame i
+#-- (keyed like TelemetryDecoder.decode, plus 'time'), with 'img' a view into frames.bin.
+#-- `frames` and `index` expose all frames at once for analysis
+class FrameStoreReader():
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.path = path
+        capacity = self.meta['capacity']
+        shape = tuple(self.meta['shape'])
+        dtype = np.dtype([tuple(field) for field in self.meta['index_dtype']])
+        index = np.memmap(os.path.join(path, INDEX_FILE), dtype=dtype, mode='r', shape=(capacity,))
+        count = self.meta['count']
+        if not self.meta['closed']:
+            #-- The recording wasn't closed cleanly: use the frames written before it stopped
+            written = index['time'] > 0
+            count = int(np.argmin(written)) if not written.all() else capacity
+        self.index = index[:count]
+        self.frames = np.memmap(os.path.join(path, FRAMES_FILE), dtype=np.uint8, mode='r',
+                                shape=(capacity,) + shape)[:count]
+        self.samples = self.meta['samples']
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        row = self.index[i]
+        telemetry = {name: row[name] for name in self.index.dtype.names}
+        telemetry["pos"] = row["pos"].tolist()
+        telemetry["img"] = self.frames[i]
+        return telemetry
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
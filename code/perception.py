@@ -1,6 +1,8 @@
 import numpy as np
 import cv2
 
+from worldmap import unique_cell_keys
+
 #--- Modified to allow for min and max thresholds.
 #--- This allows the same function to be used for terrain, obstacles and rock samples
 #--- Thresholds are 2 tuples for min and max: (minR,minG,minB), (maxR,maxG,maxB)
@@ -30,14 +32,72 @@ def color_thresh(img, thresh_min = (0,0,0), thresh_max = (255,255,255), operator
     # Return binary images
     return select
     
+#-- Single pass classifier for several color threshold classes at once.
+#-- Each class is a (thresh_min, thresh_max, operator) tuple with the same meaning as in color_thresh.
+#-- A 256 entry lookup table per RGB channel holds one bit per class, set when the channel
+#-- value is within that class's range. The class bits of a pixel are then the AND (or OR)
+#-- of its three channel lookups. All outputs are written into preallocated buffers.
+class ColorClassifier():
+    def __init__(self, classes, shape):
+        if len(classes) > 8:
+            raise ValueError('ColorClassifier supports at most 8 classes')
+        values = np.arange(256)
+        lut = np.zeros((256, 3), dtype=np.uint8)
+        self.and_bits = 0
+        self.or_bits = 0
+        for k, (thresh_min, thresh_max, operator) in enumerate(classes):
+            for c in range(3):
+                inside = (values > thresh_min[c]) & (values <= thresh_max[c])
+                lut[inside, c] |= (1 << k)
+            if operator == 'and':
+                self.and_bits |= (1 << k)
+            elif operator == 'or':
+                self.or_bits |= (1 << k)
+            else:
+                raise ValueError("Unknown operator '{}'".format(operator))
+        #-- 3 channel table for cv2.LUT
+        self.lut = lut.reshape(1, 256, 3)
+        #-- Tables to extract the 0/1 mask of each class from the class bits
+        self.class_luts = [((np.arange(256) >> k) & 1).astype(np.uint8) for k in range(len(classes))]
+        
+        rows, cols = shape[0], shape[1]
+        self.codes = np.zeros((rows, cols, 3), dtype=np.uint8)
+        self.labels = np.zeros((rows, cols), dtype=np.uint8)
+        self.any_bits = np.zeros((rows, cols), dtype=np.uint8)
+        self.masks = [np.zeros((rows, cols), dtype=np.uint8) for k in range(len(classes))]
+
+    #-- Label every pixel of img. Returns the class bits image (bit k set if pixel is in class k)
+    def classify(self, img):
+        codes = cv2.LUT(img, self.lut, dst=self.codes)
+        labels = self.labels
+        np.bitwise_and(codes[:,:,0], codes[:,:,1], out=labels)
+        np.bitwise_and(labels, codes[:,:,2], out=labels)
+        if self.or_bits:
+            any_bits = self.any_bits
+            np.bitwise_or(codes[:,:,0], codes[:,:,1], out=any_bits)
+            np.bitwise_or(any_bits, codes[:,:,2], out=any_bits)
+            np.bitwise_and(labels, self.and_bits, out=labels)
+            np.bitwise_and(any_bits, self.or_bits, out=any_bits)
+            np.bitwise_or(labels, any_bits, out=labels)
+        return labels
+
+    #-- Label every pixel of img and return one binary (0/1) image per class,
+    #-- identical to calling color_thresh once per class.
+    #-- NOTE: the returned images are overwritten by the next call
+    def binary_images(self, img):
+        labels = self.classify(img)
+        for class_lut, mask in zip(self.class_luts, self.masks):
+            cv2.LUT(labels, class_lut, dst=mask)
+        return self.masks
+
 # Define a function to convert to rover-centric coordinates
 def rover_coords(binary_img):
     # Identify nonzero pixels
     ypos, xpos = binary_img.nonzero()
     # Calculate pixel positions with reference to the rover position being at the 
     # center bottom of the image.  
-    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float)
+    x_pixel = np.absolute(ypos - binary_img.shape[0]).astype(np.float64)
+    y_pixel = -(xpos - binary_img.shape[0]).astype(np.float64)
     return x_pixel, y_pixel
 
 
@@ -51,6 +111,131 @@ def to_polar_coords(x_pixel, y_pixel):
     angles = np.arctan2(y_pixel, x_pixel)
     return dist, angles
 
+#-- Rover-centric coordinates of every pixel of the warped image.
+#-- The pixel -> (x, y, distance, angle) mapping only depends on the image geometry,
+#-- so it is computed once and then indexed with the lit pixels of each binary image.
+#-- Same reference as rover_coords and to_polar_coords: rover at the center bottom of the image.
+#-- A grid can also cover a window of a warped image of full_rows rows, starting at pixel
+#-- `origin` with one grid pixel every `step` pixels. Coordinates are then those of the
+#-- centers of the step x step blocks, still in warped image pixels.
+class RoverGrid():
+    def __init__(self, shape, origin=(0, 0), step=1, full_rows=None):
+        rows, cols = shape[0], shape[1]
+        self.shape = (rows, cols)
+        if full_rows is None:
+            full_rows = rows
+        ypos, xpos = np.mgrid[0:rows, 0:cols]
+        if step != 1 or origin != (0, 0):
+            ypos = ypos * step + origin[0] + (step - 1) / 2
+            xpos = xpos * step + origin[1] + (step - 1) / 2
+        x_pixel = np.absolute(ypos - full_rows).astype(np.float64).ravel()
+        y_pixel = -(xpos - full_rows).astype(np.float64).ravel()
+        dist, angles = to_polar_coords(x_pixel, y_pixel)
+        self.x = x_pixel.astype(np.float32)
+        self.y = y_pixel.astype(np.float32)
+        self.dist = dist.astype(np.float32)
+        self.angles = angles.astype(np.float32)
+
+    #-- Flat indices of the nonzero pixels of a binary image (same order as nonzero())
+    def indices(self, binary_img):
+        return np.flatnonzero(binary_img)
+
+    #-- Rover-centric x, y of the pixels at idx
+    def coords(self, idx):
+        return self.x[idx], self.y[idx]
+
+    #-- Distances and angles of the pixels at idx
+    def polar(self, idx):
+        return self.dist[idx], self.angles[idx]
+
+    #-- First flat index of a pixel that can be closer than max_dist. The forward distance x
+    #-- shrinks row by row towards the bottom of the image and bounds the distance from below,
+    #-- so every pixel in the rows before this one is at least max_dist away
+    def band_start(self, max_dist):
+        row_x = self.x[::self.shape[1]]
+        return int(np.argmax(row_x < max_dist)) * self.shape[1] if (row_x < max_dist).any() else self.x.size
+
+#-- Polar coordinates of one pixel class of one frame, evaluated lazily.
+#-- Holds the flat pixel indices into a RoverGrid. Distances and angles are only gathered when
+#-- read, and only for the pixels within the distance band asked for (max_dist, in warped image
+#-- pixels). Results are memoized for the frame, so decision branches reading the same view
+#-- only pay for it once. count() is in full resolution pixels: with reduced perception each
+#-- pixel stands for `weight` of them (see PerceptionROI).
+class PolarView():
+    def __init__(self, grid, idx, weight=1):
+        self.grid = grid
+        self.idx = idx
+        self.weight = weight
+        self._memo = {}
+
+    #-- View with no pixels
+    @staticmethod
+    def empty():
+        return PolarView(get_rover_grid((1, 1)), np.zeros(0, dtype=np.intp))
+
+    #-- Number of pixels at this view's resolution
+    def __len__(self):
+        return len(self.idx)
+
+    #-- Flat indices of the pixels closer than max_dist (all pixels if max_dist is None).
+    #-- Pixel indices are sorted, so only the tail of idx from the band's first row is examined
+    def within(self, max_dist=None):
+        if max_dist is None:
+            return self.idx
+        key = ('within', max_dist)
+        band = self._memo.get(key)
+        if band is None:
+            tail = self.idx[np.searchsorted(self.idx, self.grid.band_start(max_dist)):]
+            band = tail[self.grid.dist[tail] < max_dist]
+            self._memo[key] = band
+        return band
+
+    #-- Number of full resolution pixels closer than max_dist
+    def count(self, max_dist=None):
+        return len(self.within(max_dist)) * self.weight
+
+    #-- Distances of the pixels closer than max_dist
+    def dists(self, max_dist=None):
+        return self._values('dists', self.grid.dist, max_dist)
+
+    #-- Angles (radians) of the pixels closer than max_dist
+    def angles(self, max_dist=None):
+        return self._values('angles', self.grid.angles, max_dist)
+
+    #-- Mean angle in degrees of the pixels closer than max_dist, nan if there are none
+    def mean_angle(self, max_dist=None):
+        key = ('mean_angle', max_dist)
+        mean = self._memo.get(key)
+        if mean is None:
+            angles = self.angles(max_dist)
+            mean = np.mean(angles * 180/np.pi) if len(angles) else np.nan
+            self._memo[key] = mean
+        return mean
+
+    #-- Memory held by the view's arrays in bytes
+    def nbytes(self):
+        return self.idx.nbytes + sum(value.nbytes for value in self._memo.values()
+                                     if isinstance(value, np.ndarray))
+
+    def _values(self, name, table, max_dist):
+        key = (name, max_dist)
+        values = self._memo.get(key)
+        if values is None:
+            values = table[self.within(max_dist)]
+            self._memo[key] = values
+        return values
+
+#-- Rover grids for each image shape seen so far
+_rover_grids = {}
+
+def get_rover_grid(shape):
+    key = (shape[0], shape[1])
+    grid = _rover_grids.get(key)
+    if grid is None:
+        grid = RoverGrid(shape)
+        _rover_grids[key] = grid
+    return grid
+
 # Define a function to apply a rotation to pixel positions
 #--- Modified to complete rotation function
 def rotate_pix(xpix, ypix, yaw):
@@ -81,11 +266,102 @@ def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
     # Apply translation
     xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
     # Perform rotation, translation and clipping all at once
-    x_pix_world = np.clip(np.int_(xpix_tran), 0, world_size - 1)
-    y_pix_world = np.clip(np.int_(ypix_tran), 0, world_size - 1)
+    x_pix_world = np.clip(xpix_tran, 0, world_size - 1)
+    y_pix_world = np.clip(ypix_tran, 0, world_size - 1)
     # Return the result
     return x_pix_world, y_pix_world
     
+#-- Rotation matrix for a yaw angle in degrees, scaled from rover pixels to world units.
+#-- Only depends on the pose, so it is computed once per frame and shared by all pixel classes
+def rotation_matrix(yaw, scale=1):
+    yaw_rad = yaw * np.pi / 180
+    cos_yaw = np.cos(yaw_rad) / scale
+    sin_yaw = np.sin(yaw_rad) / scale
+    return np.float32([[cos_yaw, -sin_yaw], [sin_yaw, cos_yaw]])
+
+#-- Fused rotation, translation and clipping of rover-centric pixels into world coordinates.
+#-- Equivalent to pix_to_world, but all pixel classes are transformed in one batched call,
+#-- in float32, with a single truncation and clip step. With world_size None the map is
+#-- unbounded and cells are floored instead of clipped. Work and output buffers are
+#-- preallocated and only reallocated when a frame has more pixels than ever before.
+class WorldProjector():
+    def __init__(self, world_size, scale, capacity=0):
+        self.world_size = world_size
+        self.scale = scale
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.xbuf = np.empty(capacity, dtype=np.float32)
+        self.ybuf = np.empty(capacity, dtype=np.float32)
+        self.tmp = np.empty(capacity, dtype=np.float32)
+        self.tmp2 = np.empty(capacity, dtype=np.float32)
+        self.x_world = np.empty(capacity, dtype=np.intp)
+        self.y_world = np.empty(capacity, dtype=np.intp)
+
+    #-- Transform the pixel classes for the rover pose, gathering the rover-centric pixels
+    #-- straight from a RoverGrid with the flat pixel indices of each class.
+    #-- rot can be a precomputed rotation_matrix(yaw, scale) for the pose.
+    #-- Returns a list of (x_world, y_world) per class.
+    #-- NOTE: the returned arrays are views into buffers overwritten by the next call
+    def project_indices(self, grid, idx_list, xpos, ypos, yaw, rot=None):
+        counts = [len(idx) for idx in idx_list]
+        n = sum(counts)
+        if n > self.capacity:
+            self._allocate(n)
+        start = 0
+        for idx, count in zip(idx_list, counts):
+            np.take(grid.x, idx, out=self.xbuf[start:start + count])
+            np.take(grid.y, idx, out=self.ybuf[start:start + count])
+            start += count
+        return self._transform(n, counts, xpos, ypos, yaw, rot)
+
+    def _transform(self, n, counts, xpos, ypos, yaw, rot):
+        if rot is None:
+            rot = rotation_matrix(yaw, self.scale)
+        xbuf, ybuf = self.xbuf[:n], self.ybuf[:n]
+        tmp, tmp2 = self.tmp[:n], self.tmp2[:n]
+        #-- x_world = xpos + (xpix * cos(yaw) - ypix * sin(yaw)) / scale
+        np.multiply(xbuf, rot[0,0], out=tmp)
+        np.multiply(ybuf, rot[0,1], out=tmp2)
+        tmp += tmp2
+        tmp += xpos
+        #-- y_world = ypos + (xpix * sin(yaw) + ypix * cos(yaw)) / scale
+        np.multiply(xbuf, rot[1,0], out=xbuf)
+        np.multiply(ybuf, rot[1,1], out=tmp2)
+        xbuf += tmp2
+        xbuf += ypos
+        if self.world_size is None:
+            #-- Unbounded map: floor to integer cells (the cast below truncates towards zero)
+            np.floor(tmp, out=tmp)
+            np.floor(xbuf, out=xbuf)
+        else:
+            #-- Clip to the map and truncate to integer cells in a single step
+            top = self.world_size - 1
+            np.clip(tmp, 0, top, out=tmp)
+            np.clip(xbuf, 0, top, out=xbuf)
+        x_world, y_world = self.x_world[:n], self.y_world[:n]
+        np.copyto(x_world, tmp, casting='unsafe')
+        np.copyto(y_world, xbuf, casting='unsafe')
+        # Split the result back into the pixel classes
+        world_list = []
+        start = 0
+        for count in counts:
+            world_list.append((x_world[start:start + count], y_world[start:start + count]))
+            start += count
+        return world_list
+
+#-- World projectors for each world size and scale seen so far
+_world_projectors = {}
+
+def get_world_projector(world_size, scale):
+    key = (world_size, scale)
+    projector = _world_projectors.get(key)
+    if projector is None:
+        projector = WorldProjector(world_size, scale)
+        _world_projectors[key] = projector
+    return projector
+
 # Define a function to perform a perspective transform
 def perspect_transform(img, src, dst):
            
@@ -94,6 +370,254 @@ def perspect_transform(img, src, dst):
     
     return warped
 
+#-- Calibration box in source (actual) and destination (desired) coordinates
+#-- The destination box will be 2*DST_SIZE on each side
+DST_SIZE = 5
+#-- Bottom offset to account for the fact that the bottom of the image
+#-- is not the position of the rover but a bit in front of it
+BOTTOM_OFFSET = 6
+SOURCE = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+#-- The calibration box is 1m on each side, so warped image pixels are 0.1m
+PIXELS_PER_METER = 2 * DST_SIZE
+
+#-- Returns the source and destination points of the perspective transform for an image shape
+def calibration_points(shape):
+    destination = np.float32([[shape[1]/2 - DST_SIZE, shape[0] - BOTTOM_OFFSET],
+                  [shape[1]/2 + DST_SIZE, shape[0] - BOTTOM_OFFSET],
+                  [shape[1]/2 + DST_SIZE, shape[0] - 2*DST_SIZE - BOTTOM_OFFSET],
+                  [shape[1]/2 - DST_SIZE, shape[0] - 2*DST_SIZE - BOTTOM_OFFSET],
+                  ])
+    return SOURCE, destination
+
+#-- For every destination pixel (xs, ys) of the perspective transform M find the source pixel
+#-- it samples from (inverse mapping). Returns float32 cv2.remap maps
+def source_maps(M, xs, ys):
+    Minv = np.linalg.inv(M)
+    w = Minv[2,0]*xs + Minv[2,1]*ys + Minv[2,2]
+    #-- Pixels on the horizon line (w == 0) have no source pixel
+    horizon = (w == 0)
+    w[horizon] = 1
+    map_x = ((Minv[0,0]*xs + Minv[0,1]*ys + Minv[0,2]) / w).astype(np.float32)
+    map_y = ((Minv[1,0]*xs + Minv[1,1]*ys + Minv[1,2]) / w).astype(np.float32)
+    map_x[horizon] = -1
+    map_y[horizon] = -1
+    return map_x, map_y
+
+#-- Perspective transform built once per calibration.
+#-- The transform matrix, float cv2.remap lookup maps and the field of view mask are
+#-- precomputed, so warping a frame is a single cv2.remap call. The output is nearly, not
+#-- exactly, the same as perspect_transform: about 0.1% of pixels differ, from rounding in
+#-- the interpolation (see benchmark.py). The speedup over cv2.warpPerspective is small.
+class WarpEngine():
+    def __init__(self, src, dst, shape):
+        rows, cols = shape[0], shape[1]
+        self.shape = (rows, cols)
+        self.M = cv2.getPerspectiveTransform(src, dst)
+        xs, ys = np.meshgrid(np.arange(cols, dtype=np.float64), np.arange(rows, dtype=np.float64))
+        map_x, map_y = source_maps(self.M, xs, ys)
+        self.map_x, self.map_y = map_x, map_y
+        #-- Field of view mask. 1 where the warped pixel comes from inside the camera image
+        self.fov_mask = cv2.remap(np.ones((rows, cols), dtype=np.uint8), map_x, map_y,
+                                  cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        #-- Output buffer, reused every frame
+        self.warped = np.zeros((rows, cols, 3), dtype=np.uint8)
+
+    #-- Warp a camera image into the preallocated output buffer.
+    #-- NOTE: the returned image is overwritten by the next call
+    def warp(self, img):
+        return cv2.remap(img, self.map_x, self.map_y, cv2.INTER_LINEAR, dst=self.warped,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+#-- Warp engines for each image shape seen so far. The calibration is fixed
+#-- so these only ever need to be built once
+_warp_engines = {}
+
+def get_warp_engine(shape):
+    key = (shape[0], shape[1])
+    engine = _warp_engines.get(key)
+    if engine is None:
+        source, destination = calibration_points(shape)
+        engine = WarpEngine(source, destination, shape)
+        _warp_engines[key] = engine
+    return engine
+
+#-- Reduced perception: the warp restricted to a region of interest of the warped image,
+#-- optionally at 1/step of the resolution.
+#-- The region is the part of the field of view (WarpEngine.fov_mask) within max_range meters
+#-- of the rover (the whole field of view if max_range is None). Only its bounding box is
+#-- warped, straight from the camera image at the reduced resolution: each pixel samples the
+#-- center of its step x step block. Pixels outside the region are warped to black like the
+#-- pixels outside the field of view. `grid` gives the rover-centric coordinates of the
+#-- reduced pixels in full resolution warped pixels, so projection and polar coordinates use
+#-- the same units and scale as full resolution perception. Each reduced pixel stands for
+#-- step*step full resolution pixels.
+class PerceptionROI():
+    def __init__(self, shape, step=1, max_range=None):
+        rows, cols = shape[0], shape[1]
+        engine = get_warp_engine(shape)
+        region = engine.fov_mask > 0
+        if max_range is not None:
+            full_grid = get_rover_grid(shape)
+            region &= (full_grid.dist.reshape(rows, cols) < max_range * PIXELS_PER_METER)
+        region_rows, region_cols = np.nonzero(region)
+        # Bounding box of the region, grown to whole step x step blocks
+        self.row0 = int(region_rows.min()) // step * step
+        self.col0 = int(region_cols.min()) // step * step
+        row1 = min(rows, -(-(int(region_rows.max()) + 1) // step) * step)
+        col1 = min(cols, -(-(int(region_cols.max()) + 1) // step) * step)
+        self.step = step
+        self.shape = ((row1 - self.row0) // step, (col1 - self.col0) // step)
+        self.box_shape = (self.shape[0] * step, self.shape[1] * step)
+        self.grid = RoverGrid(self.shape, (self.row0, self.col0), step, rows)
+        # Sample the block centers and drop the pixels outside the region
+        centers = (step - 1) / 2
+        xs, ys = np.meshgrid(self.col0 + centers + step * np.arange(self.shape[1], dtype=np.float64),
+                             self.row0 + centers + step * np.arange(self.shape[0], dtype=np.float64))
+        self.map_x, self.map_y = source_maps(engine.M, xs, ys)
+        inside = region[np.int_(ys), np.int_(xs)]
+        self.map_x[~inside] = -1
+        self.map_y[~inside] = -1
+        self.warped = np.zeros(self.shape + (3,), dtype=np.uint8)
+        self.vision = np.zeros(self.shape + (3,), dtype=np.uint8)
+
+    #-- Warp the region of a camera image. The returned image is overwritten by the next call
+    def warp(self, img):
+        return cv2.remap(img, self.map_x, self.map_y, cv2.INTER_LINEAR, dst=self.warped,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    #-- Draw the threshold images into the full resolution vision image
+    def draw_vision(self, vision_image, thresh_obs, thresh_rock, thresh_nav):
+        cv2.merge((thresh_obs, thresh_rock, thresh_nav), dst=self.vision)
+        self.vision *= 255
+        vision_image[:] = 0
+        row1, col1 = self.row0 + self.box_shape[0], self.col0 + self.box_shape[1]
+        vision_image[self.row0:row1, self.col0:col1] = cv2.resize(
+            self.vision, (self.box_shape[1], self.box_shape[0]), interpolation=cv2.INTER_NEAREST)
+
+#-- With a limited perception range, pixels beyond it are never seen. Counts over the whole view
+#-- (nav_view.count() against stop_forward and go_forward) are therefore lower than with full
+#-- perception and aren't rescaled: near a wall, where those thresholds matter, the terrain left
+#-- is all close to the rover and the counts agree, so scaling them by the area kept would drive
+#-- the rover into walls. The rover stops and turns in open terrain a little more readily instead.
+#-- The bands decision_step steers and checks for obstacles in (up to nav_close) must be fully
+#-- seen, so shorter ranges are rejected with a ValueError
+def check_perception_range(Rover):
+    if Rover.perception_range is not None and Rover.perception_range < min_perception_range(Rover):
+        raise ValueError('perception_range must be at least {:g} m, the nav_close steering distance'.format(
+                         min_perception_range(Rover)))
+
+#-- Shortest perception_range (meters) check_perception_range accepts
+def min_perception_range(Rover):
+    return Rover.nav_close / PIXELS_PER_METER
+
+#-- Regions of interest for each image shape, step and range
+_perception_rois = {}
+
+def get_perception_roi(shape, step=1, max_range=None):
+    key = (shape[0], shape[1], step, max_range)
+    roi = _perception_rois.get(key)
+    if roi is None:
+        roi = PerceptionROI(shape, step, max_range)
+        _perception_rois[key] = roi
+    return roi
+
+
+#-- Min and Max threshold's and operators for navigable terrain, obstacles, and rock samples
+#-- OR seems to work better for obstacles and AND for terrain and rocks
+NAV_THRESH = ((160, 160, 160), (255, 255, 255), 'and')
+OBS_THRESH = ((5, 5, 5), (70, 70, 70), 'or')
+ROCK_THRESH = ((170, 130, 0), (255, 190, 60), 'and')
+
+#-- Color classifiers for each image shape seen so far
+_color_classifiers = {}
+
+def get_color_classifier(shape):
+    key = (shape[0], shape[1])
+    classifier = _color_classifiers.get(key)
+    if classifier is None:
+        classifier = ColorClassifier((NAV_THRESH, OBS_THRESH, ROCK_THRESH), shape)
+        _color_classifiers[key] = classifier
+    return classifier
+
+
+#-- To optimize map fidelity, the map is only updated when pitch and roll are near zero
+def map_update_allowed(roll, pitch, roll_max, pitch_max):
+    return (((roll < roll_max) | (roll > 360-roll_max))
+          & ((pitch < pitch_max) | (pitch > 360-pitch_max)))
+
+#-- Temporal subsampling of world map updates. At 20-60 FPS consecutive frames mostly see the
+#-- same cells, so the map is only updated once the rover has moved Rover.map_min_move meters
+#-- or turned Rover.map_min_turn degrees since the last update, or after Rover.map_max_skip
+#-- skipped frames. Off with map_max_skip = 0 (the default), since the skipped frames'
+#-- evidence is lost: a slightly smaller, different map. Only called for frames that pass
+#-- map_update_allowed. Returns True if this frame should update the map
+def map_update_due(Rover):
+    last = Rover.map_pose
+    if last is not None and Rover.map_skipped < Rover.map_max_skip:
+        moved = np.hypot(Rover.pos[0] - last[0], Rover.pos[1] - last[1])
+        turned = abs((Rover.yaw - last[2] + 180) % 360 - 180)
+        if moved < Rover.map_min_move and turned < Rover.map_min_turn:
+            Rover.map_skipped += 1
+            return False
+    Rover.map_pose = (Rover.pos[0], Rover.pos[1], Rover.yaw)
+    Rover.map_skipped = 0
+    return True
+
+#-- Add the world cells (cell keys) of one frame to Rover.worldmap and the map statistics.
+#-- Set assume_unique if each array is already sorted and deduplicated
+def update_worldmap(Rover, obs_cells, rock_cells, nav_cells, assume_unique=False):
+    #-- Accumulate obstacle, rock sample and navigable terrain evidence in the occupancy grid
+    touched = Rover.worldmap.update(obs_cells, rock_cells, nav_cells, assume_unique)
+    #-- Keep the map statistics up to date with the cells touched this frame
+    Rover.map_stats.update(Rover.worldmap, touched)
+    #-- Grow the exploration frontier with the cells touched this frame
+    Rover.frontiers.update(touched)
+    #-- Confirm rock samples against the rock cells seen this frame
+    if Rover.rock_tracker is not None:
+        Rover.rock_tracker.update(rock_cells)
+    #-- Let the go_home planner know which cells changed, so it only replans when the path is affected
+    if Rover.home_planner is not None:
+        Rover.home_planner.notify(touched)
+
+#-- Key of Rover.map_cache for a frame seen from pos, yaw, pitch and roll with the given
+#-- (navigable, obstacle, rock) pixel counts and the Rover's map and perception settings
+def map_cache_key(Rover, pos, yaw, pitch, roll, counts):
+    return Rover.map_cache.key(pos, yaw, pitch, roll, tuple(counts) + (
+        Rover.worldmap.cells_per_meter, Rover.perception_scale, Rover.perception_range))
+
+#-- The per-frame part of perception_step for bulk processing of recorded runs:
+#-- warp, threshold and project one camera image for the given pose.
+#-- Returns (cells, counts): the world cell keys (see worldmap.cell_keys) of the obstacle,
+#-- rock and navigable pixels as compact deduplicated arrays and the (navigable, obstacle,
+#-- rock) pixel counts for map_cache_key, or (None, None) if the pitch/roll gate rejects
+#-- the frame. Does not depend on any Rover state, so frames can be processed in parallel
+#-- and merged with merge_world_cells in timestamp order.
+def world_cells(img, xpos, ypos, yaw, pitch, roll, cells_per_meter, roll_max, pitch_max):
+    if not map_update_allowed(roll, pitch, roll_max, pitch_max):
+        return None, None
+    warped = get_warp_engine(img.shape).warp(img)
+    thresh_nav, thresh_obs, thresh_rock = get_color_classifier(warped.shape).binary_images(warped)
+    grid = get_rover_grid(warped.shape)
+    idx_list = (grid.indices(thresh_obs), grid.indices(thresh_rock), grid.indices(thresh_nav))
+    projector = get_world_projector(None, PIXELS_PER_METER / cells_per_meter)
+    world_list = projector.project_indices(grid, idx_list, xpos * cells_per_meter,
+                                           ypos * cells_per_meter, yaw)
+    counts = (len(idx_list[2]), len(idx_list[0]), len(idx_list[1]))
+    return tuple(unique_cell_keys(x_world, y_world) for x_world, y_world in world_list), counts
+
+#-- Merge the output of world_cells into Rover.worldmap (the reducer of bulk processing).
+#-- With the frame's map_cache_key, the cells go through Rover.map_cache as in perception_step:
+#-- the cached cells of an earlier frame with the same key are merged instead
+def merge_world_cells(Rover, cells, key=None):
+    if cells is not None:
+        if key is not None and Rover.map_cache is not None:
+            cached = Rover.map_cache.get(key)
+            if cached is None:
+                Rover.map_cache.put(key, cells)
+            else:
+                cells = cached
+        update_worldmap(Rover, cells[0], cells[1], cells[2], assume_unique=True)
+    return Rover
 
 # Apply the above functions in succession and update the Rover state accordingly
 def perception_step(Rover):
@@ -101,98 +625,109 @@ def perception_step(Rover):
     # TODO: 
     # NOTE: camera image is coming to you in Rover.img
     img = Rover.img
+    #-- Sub-step timing, a no-op unless Rover.profiler is a StageProfiler
+    profiler = Rover.profiler
+    t = profiler.tic()
     
     # 1) Define source and destination points for perspective transform
-    
-    # Define calibration box in source (actual) and destination (desired) coordinates
-    # The destination box will be 2*dst_size on each side
-    dst_size = 5 
-    # Set a bottom offset to account for the fact that the bottom of the image 
-    # is not the position of the rover but a bit in front of it
-    bottom_offset = 6
-    source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
-    destination = np.float32([[img.shape[1]/2 - dst_size, img.shape[0] - bottom_offset],
-                  [img.shape[1]/2 + dst_size, img.shape[0] - bottom_offset],
-                  [img.shape[1]/2 + dst_size, img.shape[0] - 2*dst_size - bottom_offset], 
-                  [img.shape[1]/2 - dst_size, img.shape[0] - 2*dst_size - bottom_offset],
-                  ])
+    #-- Calibration is fixed, so the transform is only set up once per image shape.
+    #-- With a reduced perception mode (Rover.perception_scale, Rover.perception_range) only
+    #-- the region of interest is warped, at the reduced resolution
+    roi = None
+    if Rover.perception_scale != 1 or Rover.perception_range is not None:
+        check_perception_range(Rover)
+        roi = get_perception_roi(img.shape, Rover.perception_scale, Rover.perception_range)
+        warp_engine = roi
+    else:
+        warp_engine = get_warp_engine(img.shape)
     
     # 2) Apply perspective transform
-    warped = perspect_transform(img, source, destination)
+    warped = warp_engine.warp(img)
+    t = profiler.toc('perception.warp', t)
     
     # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
     
-    #-- Min and Max threshold's for navigable terrain, obstacles, and rock samples
-    nav_min = (160, 160, 160)
-    nav_max = (255,255,255)
-    obs_min = (5, 5, 5)
-    obs_max = (70,70,70)
-    rock_min = (170, 130, 0)
-    rock_max = (255, 190, 60)
-    
-    #-- Call modified color_thresh function on the warped image.
+    #-- Classify the warped image into terrain, obstacles and rock samples in a single pass.
     #-- Returns threshold images for terrain, obstacles and rock samples
-    thresh_nav = color_thresh(warped, nav_min, nav_max, 'and')
-    thresh_obs = color_thresh(warped, obs_min, obs_max, 'or')
-    thresh_rock = color_thresh(warped, rock_min, rock_max, 'and')
+    thresh_nav, thresh_obs, thresh_rock = get_color_classifier(warped.shape).binary_images(warped)
+    t = profiler.toc('perception.classify', t)
     
     # 4) Update Rover.vision_image (this will be displayed on left side of screen)
         # Example: Rover.vision_image[:,:,0] = obstacle color-thresholded binary image
         #          Rover.vision_image[:,:,1] = rock_sample color-thresholded binary image
         #          Rover.vision_image[:,:,2] = navigable terrain color-thresholded binary image
-    Rover.vision_image[:,:,0] = thresh_obs * 255
-    Rover.vision_image[:,:,1] = thresh_rock * 255
-    Rover.vision_image[:,:,2] = thresh_nav * 255
+    if roi is None:
+        Rover.vision_image[:,:,0] = thresh_obs * 255
+        Rover.vision_image[:,:,1] = thresh_rock * 255
+        Rover.vision_image[:,:,2] = thresh_nav * 255
+    else:
+        roi.draw_vision(Rover.vision_image, thresh_obs, thresh_rock, thresh_nav)
+    t = profiler.toc('perception.vision', t)
         
     # 5) Convert map image pixel values to rover-centric coords
     
-    # Extract navigable terrain pixels in rover-centric frame
-    xpix_nav, ypix_nav = rover_coords(thresh_nav)
-    # Extract obstacle pixels in rover-centric frame
-    xpix_obs, ypix_obs = rover_coords(thresh_obs)
-    # Extract rock pixels in rover-centric frame
-    xpix_rock, ypix_rock = rover_coords(thresh_rock)
+    #-- Rover-centric coordinates are looked up in a precomputed per-pixel table.
+    #-- Only the flat pixel indices of each class are needed here
+    grid = get_rover_grid(warped.shape) if roi is None else roi.grid
+    # Extract navigable terrain pixels
+    nav_idx = grid.indices(thresh_nav)
+    # Extract obstacle pixels
+    obs_idx = grid.indices(thresh_obs)
+    # Extract rock pixels
+    rock_idx = grid.indices(thresh_rock)
+    t = profiler.toc('perception.indices', t)
     
     # 6) Convert rover-centric pixel values to world coordinates
     
-    # scale since 1 pixel = 1m in map but 0.1m in image
-    scale = 10
-    # Convert terrain, obstacles and rock sample pixels to world coord frame.
-    # Pass rover x, y, yaw from data class
-    # Get navigable terrain pixel positions in world coords
-    navigable_x_world, navigable_y_world = pix_to_world(xpix_nav, ypix_nav,
-                                Rover.pos[0], Rover.pos[1], Rover.yaw, 
-                                Rover.worldmap.shape[0], scale)
-    # Get obstacle pixel positions in world coords
-    obs_x_world, obs_y_world = pix_to_world(xpix_obs, ypix_obs,
-                                Rover.pos[0], Rover.pos[1], Rover.yaw, 
-                                Rover.worldmap.shape[0], scale)
-    # Get rock pixel positions in world coords
-    rock_x_world, rock_y_world = pix_to_world(xpix_rock, ypix_rock,
-                                Rover.pos[0], Rover.pos[1], Rover.yaw, 
-                                Rover.worldmap.shape[0], scale)
+    #-- The world map is only updated when pitch and roll are near zero (checked first, so
+    #-- rejected frames skip the projection) and the pose has changed enough since the last
+    #-- update (see map_update_due). The polar coordinates below are still updated on every frame.
+    #-- The project and map_update stages are timed on every frame, also when they do no work
+    cells = None
+    if (map_update_allowed(Rover.roll, Rover.pitch, Rover.roll_max, Rover.pitch_max)
+            and map_update_due(Rover)):
+        #-- Frames from the same pose with the same pixel counts see the same world cells,
+        #-- so their deduplicated cells are looked up in Rover.map_cache before projecting
+        cache = Rover.map_cache
+        if cache is not None:
+            key = map_cache_key(Rover, Rover.pos, Rover.yaw, Rover.pitch, Rover.roll,
+                                (len(nav_idx), len(obs_idx), len(rock_idx)))
+            cells = cache.get(key)
+        if cells is None:
+            #-- scale since 1 pixel = 0.1m in image and 1/cells_per_meter m in map
+            cells_per_meter = Rover.worldmap.cells_per_meter
+            scale = PIXELS_PER_METER / cells_per_meter
+            # Convert terrain, obstacles and rock sample pixels to world coord frame.
+            # Pass rover x, y, yaw from data class
+            #-- All three classes are projected in one batched call with a single rotation matrix for the pose.
+            #-- The world map is unbounded, so the cells are not clipped
+            projector = get_world_projector(None, scale)
+            rot = rotation_matrix(Rover.yaw, scale)
+            (navigable_x_world, navigable_y_world), (obs_x_world, obs_y_world), (rock_x_world, rock_y_world) = \
+                projector.project_indices(grid, (nav_idx, obs_idx, rock_idx), Rover.pos[0] * cells_per_meter,
+                                          Rover.pos[1] * cells_per_meter, Rover.yaw, rot)
+            #-- Each class's cells are deduplicated once here, before any map structure sees them
+            cells = (unique_cell_keys(obs_x_world, obs_y_world), unique_cell_keys(rock_x_world, rock_y_world),
+                     unique_cell_keys(navigable_x_world, navigable_y_world))
+            if cache is not None:
+                cache.put(key, cells)
+    t = profiler.toc('perception.project', t)
     
     # 7) Update Rover worldmap (to be displayed on right side of screen)
-        # Example: Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 1
-        #          Rover.worldmap[rock_y_world, rock_x_world, 1] += 1
-        #          Rover.worldmap[navigable_y_world, navigable_x_world, 2] += 1
-    
-    #-- To optimize map fidelity, only update map when pitch and roll are near zero
-    if (((Rover.roll < Rover.roll_max) | (Rover.roll > 360-Rover.roll_max))
-      & ((Rover.pitch < Rover.pitch_max) | (Rover.pitch > 360-Rover.pitch_max))):
-        #-- Add obstacles to world map on RED layer
-        Rover.worldmap[obs_y_world, obs_x_world, 0] = 255
-        #-- Add rock samples to world map on GREEN layer. Increase weight to make locations visible
-        Rover.worldmap[rock_y_world, rock_x_world, 1] = 255
-        #-- Add navigable terrain to world map on BLUE layer
-        Rover.worldmap[navigable_y_world, navigable_x_world, 2] = 255
+    #-- Rover.worldmap is an OccupancyGrid that accumulates log-odds evidence per cell
+    if cells is not None:
+        update_worldmap(Rover, cells[0], cells[1], cells[2], assume_unique=True)
+    t = profiler.toc('perception.map_update', t)
     
     # 8) Convert rover-centric pixel positions to polar coordinates
     # Update Rover pixel distances and angles
         # Rover.nav_dists = rover_centric_pixel_distances
         # Rover.nav_angles = rover_centric_angles
-    Rover.nav_dists, Rover.nav_angles = to_polar_coords(xpix_nav, ypix_nav)
-    Rover.rock_dists, Rover.rock_angles = to_polar_coords(xpix_rock, ypix_rock)
-    Rover.obs_dists, Rover.obs_angles = to_polar_coords(xpix_obs, ypix_obs)
+    #-- Distances and angles are only computed when decision_step reads them (see PolarView)
+    weight = Rover.perception_scale**2
+    Rover.nav_view = PolarView(grid, nav_idx, weight)
+    Rover.rock_view = PolarView(grid, rock_idx, weight)
+    Rover.obs_view = PolarView(grid, obs_idx, weight)
+    profiler.toc('perception.polar', t)
     
     return Rover
\ No newline at end of file
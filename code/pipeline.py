@@ -0,0 +1,109 @@
+#-- Pipelined mode of drive_rover.py (--pipeline).
+#-- The telemetry handler only hands the raw telemetry event to a PerceptionWorker and answers
+#-- straight away with the most recent decision, so command latency doesn't depend on how long
+#-- perception takes. The worker runs update_rover, perception_step and decision_step on a
+#-- real thread (cv2 and numpy release the GIL for the heavy work) on the newest event only:
+#-- events that arrive while it is busy replace the pending one and are counted as skipped.
+#-- The worker owns the Rover while it runs. Socket.IO messages are only ever sent from the
+#-- handler, which picks up pickup requests with take_pickup(). Rover.profiler is shared by
+#-- both threads, which StageProfiler supports.
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import update_rover, create_output_images, render_output_images
+
+class PerceptionWorker():
+    def __init__(self, Rover, inset_encoder=None, record=None):
+        self.Rover = Rover
+        self.inset_encoder = inset_encoder # Encodes the output images, or None to encode on the worker
+        self.record = record # Called with (Rover, jpeg) for every processed event, to record the run
+        self.received = 0 # Events submitted
+        self.processed = 0 # Events run through perception and decision
+        self.skipped = 0 # Events replaced by a newer one before the worker got to them
+        self.commands = (0, 0, 0) # Throttle, brake and steer of the latest decision
+        self.images = ('', '') # Encoded output images when there is no inset encoder
+        self._pickup = False
+        self._pending = None
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='PerceptionWorker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    #-- Hand a telemetry event to the worker, replacing any event still waiting
+    def submit(self, data):
+        with self._cond:
+            if self._pending is not None:
+                self.skipped += 1
+            self._pending = (data, time.perf_counter())
+            self.received += 1
+            self._cond.notify()
+
+    #-- Commands and encoded output images to answer the current event with
+    def latest(self):
+        if self.inset_encoder is not None:
+            return self.commands, self.inset_encoder.latest()
+        return self.commands, self.images
+
+    #-- True once for every pickup the decision step asked for
+    def take_pickup(self):
+        with self._cond:
+            pickup, self._pickup = self._pickup, False
+        return pickup
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                data, received = self._pending
+                self._pending = None
+            #-- Keep going after a bad event, as the Socket.IO server does for the handler
+            try:
+                self._process(data, received)
+            except Exception:
+                traceback.print_exc()
+
+    def _process(self, data, received):
+        Rover = self.Rover
+        profiler = Rover.profiler
+        t = profiler.tic()
+        Rover, jpeg = update_rover(Rover, data)
+        t = profiler.toc('decode', t)
+        if np.isfinite(Rover.vel):
+            Rover = perception_step(Rover)
+            t = profiler.toc('perception', t)
+            Rover = decision_step(Rover)
+            t = profiler.toc('decision', t)
+            self.commands = (Rover.throttle, Rover.brake, Rover.steer)
+            if Rover.send_pickup and not Rover.picking_up:
+                with self._cond:
+                    self._pickup = True
+                Rover.send_pickup = False
+            if self.inset_encoder is None:
+                self.images = create_output_images(Rover)
+                t = profiler.toc('output_images', t)
+            elif self.inset_encoder.due():
+                self.inset_encoder.submit(*render_output_images(Rover))
+                t = profiler.toc('render', t)
+        else:
+            self.commands = (0, 0, 0)
+        #-- Time from the event arriving to its decision being available to the handler
+        profiler.toc('decision_age', received)
+        self.processed += 1
+        if self.record is not None:
+            self.record(Rover, jpeg)
+            profiler.toc('record', t)
@@ -0,0 +1,268 @@
+import numpy as np
+import cv2
+
+from worldmap import UNKNOWN, NAVIGABLE, OBSTACLE, cell_keys, key_coords
+
+#-- 8-connected neighbour offsets (dx, dy)
+NEIGHBOURS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+
+#-- Wavefront path planner for returning home.
+#-- A breadth-first wavefront is run outwards from home over all cells of the world map
+#-- that aren't obstacles (within plan_radius meters of home, obstacles optionally inflated
+#-- by `inflate` cells). Unexplored cells are assumed passable: the camera rarely sees the
+#-- ground right under the rover, so much of the driven track is never marked navigable.
+#-- The resulting distance field gives every reachable cell a next step towards home.
+#-- The 8-connected steps zigzag wherever the route isn't a multiple of 45 degrees, so the
+#-- path is smoothed: the waypoint is the farthest of the next `lookahead` path cells that is
+#-- in line of sight of the rover (the straight segment to it only crosses passable cells).
+#-- Straight-line homing is the special case where home itself is in line of sight.
+#-- The field is only recomputed when map cells within `corridor` cells of the current
+#-- path change state, or when the rover leaves the planned area.
+class HomePlanner():
+    def __init__(self, worldmap, home, plan_radius=25, inflate=0, lookahead=40, corridor=2):
+        self.worldmap = worldmap
+        self.home = home
+        self.inflate = inflate
+        self.lookahead = lookahead
+        self.corridor = corridor
+        cells_per_meter = worldmap.cells_per_meter
+        radius = int(np.ceil(plan_radius * cells_per_meter))
+        # Planning window in map cells, padded by one impassable cell on every side
+        self.x0 = int(np.floor(home[0] * cells_per_meter)) - radius - 1
+        self.y0 = int(np.floor(home[1] * cells_per_meter)) - radius - 1
+        self.size = 2 * radius + 3
+        self.dist = None # Wavefront distance (steps) to home, -1 if unreachable
+        self.next_cell = None # Flat index of the next cell towards home
+        self.passable = None # Passable cells the field was planned on
+        self.blocked = None # Obstacle cells of the map the field was planned on, before inflation
+        self.on_path = np.zeros((self.size, self.size), dtype=bool) # Cells near the current path
+        self.dirty = True
+        self.failed_cell = None # Start cell of the last plan that could not reach home
+        self.replans = 0
+
+    #-- Position in map cell units, relative to the planning window
+    def _local(self, pos):
+        cells_per_meter = self.worldmap.cells_per_meter
+        return pos[0] * cells_per_meter - self.x0, pos[1] * cells_per_meter - self.y0
+
+    #-- Map cell of a world position, relative to the planning window
+    def _cell(self, pos):
+        x, y = self._local(pos)
+        return int(np.floor(x)), int(np.floor(y))
+
+    def _inside(self, x, y):
+        return (0 < x < self.size - 1) and (0 < y < self.size - 1)
+
+    #-- Recompute the distance field from the current map.
+    #-- The start cell (x, y) is the rover's cell and is always treated as passable
+    def plan(self, x, y):
+        size = self.size
+        state = self.worldmap.region_state(self.x0, self.y0, size, size)
+        obstacles = (state == OBSTACLE)
+        blocked = obstacles.astype(np.uint8)
+        if self.inflate > 0:
+            kernel = np.ones((2 * self.inflate + 1, 2 * self.inflate + 1), dtype=np.uint8)
+            blocked = cv2.dilate(blocked, kernel)
+        passable = (blocked == 0)
+        home_x, home_y = self._cell(self.home)
+        passable[home_y, home_x] = True
+        passable[y, x] = True
+        # Keep the padding impassable so flat neighbour offsets never wrap around
+        passable[0, :] = passable[-1, :] = passable[:, 0] = passable[:, -1] = False
+        flat_passable = passable.ravel()
+
+        # Breadth-first wavefront from home, one ring of cells per iteration.
+        # Diagonal steps are only allowed if both cells they cut across are passable, so
+        # the path never clips the corner of an obstacle
+        offsets = np.array([dy * size + dx for dx, dy in NEIGHBOURS])
+        x_offsets = np.array([dx for dx, dy in NEIGHBOURS])
+        y_offsets = np.array([dy * size for dx, dy in NEIGHBOURS])
+        def steps(cells):
+            cells = cells[:, None]
+            return (flat_passable[cells + offsets] & flat_passable[cells + x_offsets]
+                    & flat_passable[cells + y_offsets])
+        dist = np.full(size * size, -1, dtype=np.int32)
+        frontier = np.array([home_y * size + home_x])
+        dist[frontier] = 0
+        step = 0
+        while len(frontier):
+            step += 1
+            neighbours = np.unique((frontier[:, None] + offsets)[steps(frontier)])
+            neighbours = neighbours[dist[neighbours] < 0]
+            dist[neighbours] = step
+            frontier = neighbours
+
+        # Next step of every reachable cell: the neighbour closest to home
+        reached = np.flatnonzero(dist > 0)
+        candidates = reached[:, None] + offsets
+        candidate_dist = dist[candidates].astype(np.float64)
+        candidate_dist[(candidate_dist < 0) | ~steps(reached)] = np.inf
+        next_cell = np.full(size * size, -1, dtype=np.int64)
+        next_cell[reached] = candidates[np.arange(len(reached)), np.argmin(candidate_dist, axis=1)]
+        next_cell[home_y * size + home_x] = home_y * size + home_x
+
+        self.dist = dist
+        self.next_cell = next_cell
+        self.passable = passable
+        self.blocked = obstacles
+        self.dirty = False
+        self.replans += 1
+        self._mark_path(x, y)
+
+    #-- Mark the cells along the path from (x, y), widened by `corridor` cells.
+    #-- Nothing is marked if home can't be reached from (x, y)
+    def _mark_path(self, x, y):
+        size = self.size
+        cell = y * size + x
+        self.on_path[:] = False
+        if self.dist[cell] < 0:
+            return
+        path = [cell]
+        while self.next_cell[cell] != cell:
+            cell = self.next_cell[cell]
+            path.append(cell)
+        self.on_path.ravel()[path] = True
+        if self.corridor > 0:
+            kernel = np.ones((2 * self.corridor + 1, 2 * self.corridor + 1), dtype=np.uint8)
+            self.on_path = cv2.dilate(self.on_path.astype(np.uint8), kernel).astype(bool)
+
+    #-- Tell the planner which map cells (cell keys) were touched this frame.
+    #-- Only marks the plan dirty if a cell near the current path became or stopped being an obstacle.
+    #-- Compared with the map's obstacles, not the inflated planning mask
+    def notify(self, touched):
+        if self.dirty or self.blocked is None or len(touched) == 0:
+            return
+        x_cell, y_cell = key_coords(touched)
+        x_cell, y_cell = x_cell - self.x0, y_cell - self.y0
+        inside = (x_cell >= 0) & (x_cell < self.size) & (y_cell >= 0) & (y_cell < self.size)
+        x_cell, y_cell = x_cell[inside], y_cell[inside]
+        near = self.on_path[y_cell, x_cell]
+        if not near.any():
+            return
+        state = self.worldmap.state(touched[inside][near])
+        if np.any((state == OBSTACLE) != self.blocked[y_cell[near], x_cell[near]]):
+            self.dirty = True
+
+    #-- The next `length` cells of the path from cell (flat indices), stopping at home
+    def _path(self, cell, length):
+        path = []
+        for step in range(length):
+            next_cell = self.next_cell[cell]
+            if next_cell == cell:
+                break
+            cell = next_cell
+            path.append(cell)
+        return np.array(path, dtype=np.int64) if path else np.array([cell], dtype=np.int64)
+
+    #-- Farthest cell of path (flat indices, in path order) such that it and all path cells
+    #-- before it are in line of sight of start (x, y in cell units). Segments are sampled
+    #-- every quarter cell, all at once. The first path cell is a neighbour of the rover's cell,
+    #-- so it is always used if nothing further is visible
+    def _farthest_visible(self, start, path):
+        y_end, x_end = np.divmod(path, self.size)
+        x_end, y_end = x_end + 0.5, y_end + 0.5
+        length = np.hypot(x_end - start[0], y_end - start[1])
+        t = np.linspace(0, 1, int(np.ceil(4 * length.max())) + 2)
+        x = start[0] + (x_end - start[0])[:, None] * t
+        y = start[1] + (y_end - start[1])[:, None] * t
+        visible = self.passable[y.astype(np.intp), x.astype(np.intp)].all(axis=1)
+        if visible.all():
+            return path[-1]
+        return path[max(int(np.argmin(visible)) - 1, 0)]
+
+    #-- Next waypoint (world x, y in meters) on the way home from pos,
+    #-- or None if there is no planned path from pos
+    def waypoint(self, pos):
+        x, y = self._cell(pos)
+        if not self._inside(x, y):
+            return None
+        cell = y * self.size + x
+        if self.dirty or self.dist[cell] < 0:
+            #-- Don't replan every frame from a cell home can't be reached from
+            if not self.dirty and cell == self.failed_cell:
+                return None
+            self.plan(x, y)
+            if self.dist[cell] < 0:
+                self.failed_cell = cell
+                return None
+            self.failed_cell = None
+        cell = self._farthest_visible(self._local(pos), self._path(cell, self.lookahead))
+        cells_per_meter = self.worldmap.cells_per_meter
+        y_next, x_next = divmod(int(cell), self.size)
+        # Center of the waypoint cell in world coordinates
+        return ((x_next + self.x0 + 0.5) / cells_per_meter,
+                (y_next + self.y0 + 0.5) / cells_per_meter)
+
+#-- Frontier tracker for exploration.
+#-- A frontier cell is a navigable map cell with at least `min_unknown` of its 8 neighbours
+#-- still unknown, i.e. the edge of the explored terrain. The frontier set is kept up to
+#-- date incrementally: each frame only the bounding box of the cells touched that frame
+#-- (plus a one cell margin) is re-examined.
+#-- select() picks the frontier cell to explore next: the closest one in front of the rover,
+#-- with turning away from the current heading penalised by `turn_cost` meters per radian.
+#-- Frontier cells closer than min_dist meters are ignored, since the camera never sees
+#-- the ground right around the rover.
+class FrontierTracker():
+    def __init__(self, worldmap, min_unknown=3, min_dist=3, max_dist=40, turn_cost=10, fov=np.pi/2):
+        self.worldmap = worldmap
+        self.min_unknown = min_unknown
+        self.min_dist = min_dist
+        self.max_dist = max_dist
+        self.turn_cost = turn_cost
+        self.fov = fov # Half angle of the cone in front of the rover that frontier cells are picked from
+        self.keys = np.zeros(0, dtype=np.int64) # Sorted cell keys of the frontier cells
+        self.x_cell = np.zeros(0, dtype=np.int64)
+        self.y_cell = np.zeros(0, dtype=np.int64)
+        self.target = None # Cell key of the selected frontier cell
+
+    def __len__(self):
+        return len(self.keys)
+
+    #-- Update the frontier with the map cells (cell keys) touched this frame
+    def update(self, touched):
+        if len(touched) == 0:
+            return
+        x_cell, y_cell = key_coords(touched)
+        # Cells whose frontier status may have changed: the touched box plus a one cell margin.
+        # The state is read with one more cell of margin to count their neighbours
+        x0, y0 = int(x_cell.min()) - 1, int(y_cell.min()) - 1
+        x1, y1 = int(x_cell.max()) + 1, int(y_cell.max()) + 1
+        rows, cols = y1 - y0 + 1, x1 - x0 + 1
+        state = self.worldmap.region_state(x0 - 1, y0 - 1, rows + 2, cols + 2)
+        unknown = (state == UNKNOWN).astype(np.uint8)
+        count = np.zeros((rows, cols), dtype=np.uint8)
+        for dx, dy in NEIGHBOURS:
+            count += unknown[1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols]
+        frontier = (state[1:-1, 1:-1] == NAVIGABLE) & (count >= self.min_unknown)
+        y_new, x_new = np.nonzero(frontier)
+        # Replace the old frontier cells inside the box with the new ones
+        outside = (self.x_cell < x0) | (self.x_cell > x1) | (self.y_cell < y0) | (self.y_cell > y1)
+        keys = np.concatenate((self.keys[outside], cell_keys(x_new + x0, y_new + y0)))
+        self.keys = np.sort(keys)
+        self.x_cell, self.y_cell = key_coords(self.keys)
+
+    #-- Select a frontier cell to explore from pos (meters) with heading yaw (degrees).
+    #-- Returns the world x, y (meters) of the cell center, or None if there is no frontier ahead.
+    #-- The previous target is kept as long as it is still a frontier cell and still ahead
+    def select(self, pos, yaw):
+        if len(self.keys) == 0:
+            self.target = None
+            return None
+        cells_per_meter = self.worldmap.cells_per_meter
+        dx = (self.x_cell + 0.5) / cells_per_meter - pos[0]
+        dy = (self.y_cell + 0.5) / cells_per_meter - pos[1]
+        dist = np.sqrt(dx**2 + dy**2)
+        # Bearing of each frontier cell relative to the heading, wrapped to [-pi, pi)
+        turn = np.abs((np.arctan2(dy, dx) - yaw * np.pi/180 + np.pi) % (2 * np.pi) - np.pi)
+        valid = (dist >= self.min_dist) & (dist <= self.max_dist) & (turn <= self.fov)
+        if self.target is not None:
+            i = np.searchsorted(self.keys, self.target)
+            if i < len(self.keys) and self.keys[i] == self.target and valid[i]:
+                return (self.x_cell[i] + 0.5) / cells_per_meter, (self.y_cell[i] + 0.5) / cells_per_meter
+        if not valid.any():
+            self.target = None
+            return None
+        cost = np.where(valid, dist + self.turn_cost * turn, np.inf)
+        i = np.argmin(cost)
+        self.target = self.keys[i]
+        return (self.x_cell[i] + 0.5) / cells_per_meter, (self.y_cell[i] + 0.5) / cells_per_meter
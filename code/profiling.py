@@ -0,0 +1,111 @@
+#-- Opt-in per-stage latency profiling.
+#-- Stages are timed with a running perf_counter value that each stage hands on to the next:
+#--   t = profiler.tic()
+#--   ...decode...
+#--   t = profiler.toc('decode', t)
+#--   ...perception...
+#--   t = profiler.toc('perception', t)
+#-- The last `capacity` durations of every stage are kept in a ring buffer and summarised as
+#-- percentiles on demand. NULL_PROFILER has the same interface and records nothing, so
+#-- instrumented code costs two no-op calls per stage when profiling is off.
+#-- A StageProfiler can be shared between threads (drive_rover.py --pipeline times the handler
+#-- and the perception worker with the same one): recording and summarising take a lock.
+import json
+import threading
+import time
+
+import numpy as np
+
+#-- Percentiles reported for each stage
+PERCENTILES = (50, 95, 99)
+
+class StageProfiler():
+    def __init__(self, capacity=1024, period=0):
+        self.capacity = capacity
+        self.period = period # Seconds between reports for due(). 0 never reports
+        self.samples = {} # Stage name -> ring buffer of durations in seconds
+        self.counts = {} # Stage name -> number of durations recorded
+        self.last_report = time.perf_counter()
+        self._lock = threading.Lock()
+
+    #-- Locks can't be copied or pickled, so copies (RoverState.clone) get a new one
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def tic(self):
+        return time.perf_counter()
+
+    #-- Record the time since start for stage. Returns the current time, to start the next stage
+    def toc(self, stage, start):
+        now = time.perf_counter()
+        with self._lock:
+            count = self.counts.get(stage)
+            if count is None:
+                self.samples[stage] = np.zeros(self.capacity)
+                count = 0
+            self.samples[stage][count % self.capacity] = now - start
+            self.counts[stage] = count + 1
+        return now
+
+    #-- True once every `period` seconds, to report periodically from the frame loop
+    def due(self):
+        if self.period <= 0:
+            return False
+        now = time.perf_counter()
+        if now - self.last_report < self.period:
+            return False
+        self.last_report = now
+        return True
+
+    #-- Latency summary per stage in milliseconds, over the samples still in the ring buffers:
+    #-- {stage: {'count', 'mean', 'p50', 'p95', 'p99', 'max'}}
+    def summary(self):
+        with self._lock:
+            recorded = [(stage, samples.copy(), self.counts[stage]) for stage, samples in self.samples.items()]
+        summary = {}
+        for stage, samples, count in recorded:
+            recent = samples[:min(count, self.capacity)] * 1000
+            stats = {'count': count, 'mean': float(recent.mean())}
+            for p, value in zip(PERCENTILES, np.percentile(recent, PERCENTILES)):
+                stats['p{}'.format(p)] = float(value)
+            stats['max'] = float(recent.max())
+            summary[stage] = stats
+        return summary
+
+    #-- Summary as a text table, one stage per line in the order stages were first recorded
+    def report(self):
+        columns = ['mean'] + ['p{}'.format(p) for p in PERCENTILES] + ['max']
+        lines = ['{:<24}{:>8}'.format('stage (ms)', 'count') + ''.join('{:>9}'.format(c) for c in columns)]
+        for stage, stats in self.summary().items():
+            lines.append('{:<24}{:>8}'.format(stage, stats['count'])
+                         + ''.join('{:>9.3f}'.format(stats[c]) for c in columns))
+        return '\n'.join(lines)
+
+    #-- Write the summary to a JSON file
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self.samples = {}
+            self.counts = {}
+
+#-- Profiler that records nothing. The default profiler of RoverState
+class NullProfiler():
+    def tic(self):
+        return 0
+
+    def toc(self, stage, start):
+        return 0
+
+    def due(self):
+        return False
+
+NULL_PROFILER = NullProfiler()
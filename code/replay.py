@@ -0,0 +1,372 @@
+#-- Offline replay of recorded runs (robot_log.csv + IMG/) through the real
+#-- perception_step and decision_step, without the simulator.
+#-- Rows are streamed from the log and images are decoded ahead of time by a thread pool.
+#-- The world map, per-frame stats and an optional video are written as the replay runs.
+#--
+#-- With --processes N the per-frame perception runs in a process pool instead and a single
+#-- reducer merges the resulting world cells into the world map in timestamp order.
+#--
+#-- A frame store recorded with drive_rover.py --capture can be replayed in place of a log.
+#--
+#-- Example: $ python replay.py ../test_dataset/robot_log.csv ../output/replay --video
+import argparse
+import csv
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from perception import (perception_step, world_cells, merge_world_cells, check_perception_range,
+                        min_perception_range, map_update_allowed, map_update_due, map_cache_key)
+from decision import decision_step
+from supporting_functions import render_output_images, RockTracker
+from rover_state import RoverState
+from profiling import StageProfiler
+from framestore import FrameStoreReader, is_frame_store
+
+#-- Columns of robot_log.csv
+LOG_COLUMNS = ('Path', 'SteerAngle', 'Throttle', 'Brake', 'Speed',
+               'X_Position', 'Y_Position', 'Pitch', 'Yaw', 'Roll')
+#-- Columns of the stats file written during replay
+STATS_COLUMNS = ('frame', 'time', 'mode', 'throttle', 'brake', 'steer',
+                 'nav_pixels', 'obs_pixels', 'rock_pixels', 'mapped', 'fidelity')
+#-- Columns of the stats file written during parallel replay (pixel counts are unique world cells)
+PARALLEL_STATS_COLUMNS = ('frame', 'time', 'nav_cells', 'obs_cells', 'rock_cells', 'mapped', 'fidelity')
+
+# Define a function to convert log strings to float independent of decimal convention
+def log_float(value):
+    return float(value.replace(',', '.'))
+
+#-- Resolve the image path of a log row. Logs store the path as recorded, which may be
+#-- relative to the code folder or an absolute path on another machine, so fall back
+#-- to the IMG folder next to the log file
+def resolve_image_path(path, log_dir):
+    if os.path.isfile(path):
+        return path
+    local_path = os.path.join(log_dir, path)
+    if os.path.isfile(local_path):
+        return local_path
+    return os.path.join(log_dir, 'IMG', path.replace('\\', '/').split('/')[-1])
+
+#-- Recording time of an image from its file name (robocam_%Y_%m_%d_%H_%M_%S_%f.jpg)
+def image_timestamp(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return datetime.strptime(name[len('robocam_'):], '%Y_%m_%d_%H_%M_%S_%f').timestamp()
+    except ValueError:
+        return None
+
+# Read in an image as RGB
+def read_image(path):
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError('Could not read image {}'.format(path))
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+#-- Stream the rows of a robot_log.csv as dicts, without loading the whole log
+def read_log(log_file):
+    with open(log_file, newline='') as f:
+        reader = csv.reader(f, delimiter=';')
+        header = next(reader)
+        for row in reader:
+            if row:
+                yield dict(zip(header, row))
+
+#-- Stream (row, image) pairs. Images are decoded by a thread pool up to
+#-- `prefetch` frames ahead, so only a small window of frames is ever held in memory
+def prefetch_frames(log_file, workers=4, prefetch=16):
+    log_dir = os.path.dirname(os.path.abspath(log_file))
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for row in read_log(log_file):
+            path = resolve_image_path(row['Path'], log_dir)
+            window.append((row, pool.submit(read_image, path)))
+            if len(window) >= prefetch:
+                row, future = window.popleft()
+                yield row, future.result()
+        while window:
+            row, future = window.popleft()
+            yield row, future.result()
+
+#-- Update the Rover with the telemetry of a log row, the offline equivalent of update_rover
+def update_rover_from_log(Rover, row, img, start_time):
+    Rover.vel = log_float(row['Speed'])
+    Rover.pos = [log_float(row['X_Position']), log_float(row['Y_Position'])]
+    Rover.yaw = log_float(row['Yaw'])
+    Rover.pitch = log_float(row['Pitch'])
+    Rover.roll = log_float(row['Roll'])
+    Rover.throttle = log_float(row['Throttle'])
+    Rover.steer = log_float(row['SteerAngle'])
+    Rover.img = img
+    timestamp = image_timestamp(row['Path'])
+    if timestamp is not None and start_time is not None:
+        Rover.total_time = timestamp - start_time
+    return Rover
+
+#-- Update the Rover with a frame of a frame store, the offline equivalent of update_rover
+def update_rover_from_store(Rover, telemetry, start_time):
+    Rover.vel = telemetry["vel"]
+    Rover.pos = telemetry["pos"]
+    Rover.yaw = telemetry["yaw"]
+    Rover.pitch = telemetry["pitch"]
+    Rover.roll = telemetry["roll"]
+    Rover.throttle = telemetry["throttle"]
+    Rover.steer = telemetry["steer"]
+    Rover.near_sample = telemetry["near_sample"]
+    Rover.picking_up = telemetry["picking_up"]
+    Rover.samples_found = Rover.samples_to_find - telemetry["samples_remaining"]
+    Rover.img = telemetry["img"]
+    if start_time is not None:
+        Rover.total_time = telemetry["time"] - start_time
+    return Rover
+
+#-- Initialise the sample positions and count of the Rover from a frame store, as update_rover
+#-- does on the first telemetry event
+def start_rover_from_store(Rover, store):
+    if store.samples is not None:
+        Rover.samples_pos = tuple(np.int_(samples) for samples in store.samples)
+        Rover.rock_tracker = RockTracker(Rover.samples_pos, Rover.ground_truth.shape,
+                                         Rover.worldmap.cells_per_meter)
+    if len(store):
+        Rover.samples_to_find = int(store.index['samples_remaining'][0])
+    return Rover
+
+#-- Stream (timestamp, update) pairs from a log or a frame store, where update(Rover, start_time)
+#-- loads the frame into the Rover. Frame store frames are read in place, without decoding
+def read_frames(source, Rover, workers=4, prefetch=16):
+    if is_frame_store(source):
+        store = FrameStoreReader(source)
+        start_rover_from_store(Rover, store)
+        for telemetry in store:
+            yield telemetry["time"], lambda Rover, start_time, telemetry=telemetry: \
+                update_rover_from_store(Rover, telemetry, start_time)
+    else:
+        for row, img in prefetch_frames(source, workers, prefetch):
+            yield image_timestamp(row['Path']), lambda Rover, start_time, row=row, img=img: \
+                update_rover_from_log(Rover, row, img, start_time)
+
+#-- Frame for the output video: camera and vision image on top, world map below
+def video_frame(Rover, map_img, vision_img):
+    frame = np.zeros((vision_img.shape[0] + map_img.shape[0], 2*vision_img.shape[1], 3), dtype=np.uint8)
+    frame[:Rover.img.shape[0], :Rover.img.shape[1]] = Rover.img
+    frame[:vision_img.shape[0], vision_img.shape[1]:] = vision_img
+    frame[vision_img.shape[0]:, :map_img.shape[1]] = map_img
+    return frame
+
+# Write an RGB image to disk
+def save_image(path, img):
+    cv2.imwrite(path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+
+#-- Save the part of the world map covered by the ground truth map, in the original
+#-- worldmap layout (obstacles RED, rock samples GREEN, navigable terrain BLUE)
+def save_worldmap(path, Rover):
+    rows, cols = Rover.ground_truth.shape[:2]
+    cells_per_meter = Rover.worldmap.cells_per_meter
+    np.save(path, Rover.worldmap.as_rgb(0, 0, rows * cells_per_meter, cols * cells_per_meter))
+
+#-- True if the outputs are due to be saved at this frame: every `save_every` frames, or only
+#-- at the end with save_every = 0
+def save_due(frame, save_every):
+    return save_every > 0 and frame % save_every == 0
+
+#-- Replay a log or a frame store through perception_step and decision_step.
+#-- Writes worldmap.npy, worldmap.png and stats.csv to output_dir (updated every
+#-- `save_every` frames and at the end) and optionally replay.mp4
+def replay(log_file, output_dir, video=False, fps=25, workers=4, prefetch=16, save_every=100,
+           run_decision=True, Rover=None):
+    if Rover is None:
+        Rover = RoverState()
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    writer = None
+    start_time = None
+    frame = 0
+    t0 = time.time()
+    with open(os.path.join(output_dir, 'stats.csv'), 'w', newline='') as stats_file:
+        stats = csv.writer(stats_file)
+        stats.writerow(STATS_COLUMNS)
+        for timestamp, update in read_frames(log_file, Rover, workers, prefetch):
+            if start_time is None:
+                start_time = timestamp
+                Rover.start_time = start_time
+                Rover.total_time = 0
+            profiler = Rover.profiler
+            t = profiler.tic()
+            Rover = update(Rover, start_time)
+            t = profiler.toc('update', t)
+            Rover = perception_step(Rover)
+            t = profiler.toc('perception', t)
+            if run_decision:
+                Rover = decision_step(Rover)
+                t = profiler.toc('decision', t)
+            stats.writerow((frame, round(Rover.total_time, 3), Rover.mode, Rover.throttle, Rover.brake,
+                            Rover.steer, Rover.nav_view.count(), Rover.obs_view.count(),
+                            Rover.rock_view.count(), Rover.map_stats.perc_mapped(),
+                            Rover.map_stats.fidelity()))
+
+            save = save_due(frame, save_every)
+            if video or save:
+                map_img, vision_img = render_output_images(Rover)
+            if video:
+                out_frame = video_frame(Rover, map_img, vision_img)
+                if writer is None:
+                    writer = cv2.VideoWriter(os.path.join(output_dir, 'replay.mp4'),
+                                             cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                             (out_frame.shape[1], out_frame.shape[0]))
+                writer.write(cv2.cvtColor(out_frame, cv2.COLOR_RGB2BGR))
+                t = profiler.toc('video', t)
+            if save:
+                save_image(os.path.join(output_dir, 'worldmap.png'), map_img)
+                save_worldmap(os.path.join(output_dir, 'worldmap.npy'), Rover)
+                stats_file.flush()
+            frame += 1
+
+    if writer is not None:
+        writer.release()
+    if frame > 0:
+        map_img, vision_img = render_output_images(Rover)
+        save_image(os.path.join(output_dir, 'worldmap.png'), map_img)
+    save_worldmap(os.path.join(output_dir, 'worldmap.npy'), Rover)
+    elapsed = time.time() - t0
+    print('Replayed {} frames in {:.1f} s ({:.1f} frames/s). Mapped: {}% Fidelity: {}%'.format(
+          frame, elapsed, frame / max(elapsed, 1e-9), Rover.map_stats.perc_mapped(),
+          Rover.map_stats.fidelity()))
+    if isinstance(Rover.profiler, StageProfiler):
+        print(Rover.profiler.report())
+    return Rover
+
+#-- Process pool worker: read one frame and return its recording time, pose, pixel counts
+#-- and world cells. Images are read in the worker so only the path and pose are sent to it.
+#-- Frames the map update policy skips aren't read at all
+def _frame_world_cells(task):
+    path, pose, update, cells_per_meter, roll_max, pitch_max = task
+    if not update:
+        return image_timestamp(path), pose, None, None
+    cells, counts = world_cells(read_image(path), *pose, cells_per_meter, roll_max, pitch_max)
+    return image_timestamp(path), pose, counts, cells
+
+#-- Frames of a log as tasks for _frame_world_cells. The poses are all in the log, so the
+#-- pitch/roll gate and the temporal subsampling of perception_step (map_update_due) are
+#-- applied here, in log order, on a copy of the Rover's map update state
+def _world_cell_tasks(log_file, Rover):
+    log_dir = os.path.dirname(os.path.abspath(log_file))
+    policy = Rover.snapshot()
+    for row in read_log(log_file):
+        pose = (log_float(row['X_Position']), log_float(row['Y_Position']), log_float(row['Yaw']),
+                log_float(row['Pitch']), log_float(row['Roll']))
+        policy.pos, policy.yaw = [pose[0], pose[1]], pose[2]
+        update = (map_update_allowed(pose[4], pose[3], Rover.roll_max, Rover.pitch_max)
+                  and map_update_due(policy))
+        yield (resolve_image_path(row['Path'], log_dir), pose, update, Rover.worldmap.cells_per_meter,
+               Rover.roll_max, Rover.pitch_max)
+
+#-- Replay a log with the per-frame perception spread over a process pool.
+#-- Workers return compact world cell arrays and this process merges them into the
+#-- world map in log (timestamp) order, with the same map update policy and map_cache
+#-- lookups as perception_step, so the map is the same as a serial replay.
+#-- decision_step is not run, since each decision needs the previous frame's state.
+#-- worldmap.npy and stats.csv are updated every `save_every` frames, worldmap.png at the end.
+def replay_parallel(log_file, output_dir, processes=None, chunksize=8, save_every=100, Rover=None):
+    if Rover is None:
+        Rover = RoverState()
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    start_time = None
+    frame = 0
+    t0 = time.time()
+    with open(os.path.join(output_dir, 'stats.csv'), 'w', newline='') as stats_file, \
+         Pool(processes) as pool:
+        stats = csv.writer(stats_file)
+        stats.writerow(PARALLEL_STATS_COLUMNS)
+        #-- imap returns results in log order, whatever order the workers finish in
+        for timestamp, pose, counts, cells in pool.imap(_frame_world_cells, _world_cell_tasks(log_file, Rover),
+                                                        chunksize):
+            if start_time is None:
+                start_time = timestamp
+            key = None
+            if cells is not None and Rover.map_cache is not None:
+                key = map_cache_key(Rover, pose[:2], *pose[2:], counts)
+            Rover = merge_world_cells(Rover, cells, key)
+            if timestamp is not None and start_time is not None:
+                Rover.total_time = timestamp - start_time
+            if cells is None:
+                counts = (0, 0, 0)
+            else:
+                counts = (len(cells[2]), len(cells[0]), len(cells[1]))
+            stats.writerow((frame, round(Rover.total_time or 0, 3)) + counts +
+                           (Rover.map_stats.perc_mapped(), Rover.map_stats.fidelity()))
+            if save_due(frame, save_every):
+                save_worldmap(os.path.join(output_dir, 'worldmap.npy'), Rover)
+                stats_file.flush()
+            frame += 1
+
+    if frame > 0:
+        map_img, vision_img = render_output_images(Rover)
+        save_image(os.path.join(output_dir, 'worldmap.png'), map_img)
+    save_worldmap(os.path.join(output_dir, 'worldmap.npy'), Rover)
+    elapsed = time.time() - t0
+    print('Replayed {} frames in {:.1f} s ({:.1f} frames/s) with {} processes. Mapped: {}% Fidelity: {}%'.format(
+          frame, elapsed, frame / max(elapsed, 1e-9), processes or os.cpu_count(), Rover.map_stats.perc_mapped(),
+          Rover.map_stats.fidelity()))
+    return Rover
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline replay of a recorded run')
+    parser.add_argument(
+        'log_file',
+        type=str,
+        help='Path to the robot_log.csv of the run, or to a frame store folder recorded with drive_rover.py --capture.'
+    )
+    parser.add_argument(
+        'output_dir',
+        type=str,
+        nargs='?',
+        default='../output/replay',
+        help='Folder for the world map, stats and video.'
+    )
+    parser.add_argument('--video', action='store_true', help='Write a video of the replay.')
+    parser.add_argument('--fps', type=int, default=25, help='Frame rate of the output video.')
+    parser.add_argument('--workers', type=int, default=4, help='Image decoding threads.')
+    parser.add_argument('--prefetch', type=int, default=16, help='Frames decoded ahead of perception.')
+    parser.add_argument('--save_every', type=int, default=100, help='Save the world map and stats every N frames (0 only at the end).')
+    parser.add_argument('--no_decision', action='store_true', help='Only run perception_step.')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Run perception in a pool of N processes (0 for a serial replay). '
+                             'Only the world map and stats are written in this mode.')
+    parser.add_argument('--chunksize', type=int, default=8, help='Frames sent to a process at a time.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time each stage of the serial replay and print latency percentiles at the end.')
+    parser.add_argument('--cells_per_meter', type=int, default=1, help='World map resolution in cells per meter.')
+    parser.add_argument('--map_max_skip', type=int, default=0,
+                        help='Skip world map updates for up to N frames while the pose barely changes (0 never skips).')
+    parser.add_argument('--perception_scale', type=int, default=1, choices=(1, 2, 4),
+                        help='Run perception at 1/N resolution (serial replay).')
+    parser.add_argument('--perception_range', type=float, default=None,
+                        help='Only perceive terrain within this many meters of the rover, at least {:g} (serial replay). '
+                             'Faster, but decisions differ from full perception.'.format(min_perception_range(RoverState())))
+    args = parser.parse_args()
+
+    if args.save_every < 0:
+        parser.error('--save_every must be 0 or more')
+    if args.processes > 0 and is_frame_store(args.log_file):
+        parser.error('--processes needs a robot_log.csv, not a frame store')
+    Rover = RoverState(args.cells_per_meter)
+    Rover.map_max_skip = args.map_max_skip
+    if args.processes > 0:
+        replay_parallel(args.log_file, args.output_dir, args.processes, args.chunksize, args.save_every, Rover)
+    else:
+        if args.profile:
+            Rover.profiler = StageProfiler(capacity=100000)
+        Rover.perception_scale = args.perception_scale
+        Rover.perception_range = args.perception_range
+        try:
+            check_perception_range(Rover)
+        except ValueError as error:
+            parser.error(error)
+        replay(args.log_file, args.output_dir, args.video, args.fps, args.workers, args.prefetch,
+               args.save_every, not args.no_decision, Rover)
@@ -0,0 +1,194 @@
+import os
+import copy
+from enum import IntEnum
+
+import numpy as np
+import matplotlib.image as mpimg
+
+from supporting_functions import MapStats
+from worldmap import OccupancyGrid, WorldCellCache
+from planner import FrontierTracker
+from profiling import NULL_PROFILER
+from perception import PolarView
+
+# Read in ground truth map and create 3-channel green version for overplotting
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+#-- Path is relative to this file so the state can be created from any working directory
+ground_truth = mpimg.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', 'calibration_images', 'map_bw.png'))
+# This next line creates arrays of zeros in the red and blue channels
+# and puts the map into the green channel.  This is why the underlying 
+# map output looks green in the display image
+ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float64)
+
+#-- Modes of decision_step. Integer codes, so mode checks are int compares and modes can
+#-- be stored in arrays (see batch.py). str() gives the lower case name used in logs
+class Mode(IntEnum):
+    START = 0 #-- Initial state. Saves the home position
+    FORWARD = 1
+    STOP = 2
+    VIS_TARGET = 3
+    PICKUP = 4
+    STUCK = 5
+    GO_HOME = 6
+
+    def __str__(self):
+        return self.name.lower()
+
+# Define RoverState() class to retain rover state parameters
+#-- Attributes are fixed by __slots__: access is faster, the per rover footprint is smaller
+#-- and a misspelt attribute raises AttributeError instead of silently creating a new one
+class RoverState():
+    __slots__ = ('start_time', 'total_time', 'img', 'pos', 'yaw', 'pitch', 'roll', 'vel',
+                 'steer', 'throttle', 'brake', 'nav_view', 'ground_truth', 'mode',
+                 'throttle_set', 'brake_set', 'stop_forward', 'go_forward', 'max_vel',
+                 'vision_image', 'worldmap', 'map_stats', 'frontiers', 'frontier_target',
+                 'samples_pos', 'rock_tracker', 'home_planner', 'samples_to_find', 'samples_found',
+                 'near_sample', 'picking_up', 'send_pickup', 'count', 'count1',
+                 'rock_view', 'obs_view', 'stuck', 'stuck_home',
+                 'yaw_error', 'nav_adjust', 'explore_frontiers', 'pitch_max', 'roll_max', 'home',
+                 'sample_count', 'target_yaw', 'brake_nom', 'dist_home', 'nav_close', 'home_prox',
+                 'target_angle', 'obs_stuck', 'debug', 'profiler', 'perception_scale',
+                 'perception_range', 'map_min_move', 'map_min_turn', 'map_max_skip', 'map_pose',
+                 'map_skipped', 'map_cache')
+
+    #-- cells_per_meter sets the world map resolution. The worldmap and every object built on
+    #-- its cell coordinates (frontiers, and later the rock tracker and home planner) use it
+    def __init__(self, cells_per_meter=1):
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.img = None # Current camera image
+        self.pos = None # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_view = PolarView.empty() #-- Polar coordinates of navigable terrain pixels (see perception.PolarView)
+        self.ground_truth = ground_truth_3d # Ground truth worldmap
+        self.mode = Mode.START # Current mode (can be forward or stop)
+        self.throttle_set = 0.3 # Throttle setting when accelerating
+        self.brake_set = 10 # Brake setting when braking
+        # The stop_forward and go_forward fields below represent total count
+        # of navigable terrain pixels.  This is a very crude form of knowing
+        # when you can keep going and when you should stop.  Feel free to
+        # get creative in adding new fields or modifying these!
+        self.stop_forward = 50 # Threshold to initiate stopping
+        self.go_forward = 500 # Threshold to go forward again
+        self.max_vel = 1.5 # Maximum velocity (meters/second)
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8) #-- Only ever holds 0 or 255
+        # Worldmap
+        # Update this image with the positions of navigable terrain
+        # obstacles and rock samples
+        #-- Occupancy grid with log-odds of obstacle vs navigable terrain and rock sample counts.
+        #-- Tiles are allocated as the rover explores
+        self.worldmap = OccupancyGrid(cells_per_meter=cells_per_meter)
+        #-- Map statistics and plot map, updated by perception_step with the cells written each frame
+        self.map_stats = MapStats(ground_truth_3d)
+        #-- Edge between explored navigable terrain and unknown cells, updated with the worldmap
+        self.frontiers = FrontierTracker(self.worldmap)
+        self.frontier_target = None #-- World position of the frontier cell being explored
+        self.samples_pos = None # To store the actual sample positions
+        self.rock_tracker = None #-- Confirms rock detections against samples_pos. Created with samples_pos
+        self.home_planner = None #-- Path planner back to home over the worldmap. Created on entering 'go_home'
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_found = 0 # To count the number of samples found
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+        
+        self.count = 0 #-- General purpose counter
+        self.count1 = 0 #-- General purpose counter
+        self.rock_view = PolarView.empty() #-- Polar coordinates of rock sample pixels
+        self.obs_view = PolarView.empty() #-- Polar coordinates of obstacle pixels
+        self.stuck = False #-- Stuck flag
+        self.stuck_home = False #-- Stuck flag in go_home state
+        self.yaw_error = 0 #-- Holds the error between current and desired yaw angle
+        self.nav_adjust = 13.0 #-- Navigation offset angle to hug the right wall (13 works well)
+        self.explore_frontiers = True #-- Steer towards frontier targets in 'forward' mode. Wall hugging is used when False or no frontier is ahead
+        self.pitch_max = 0.2 #-- Maximum pitch for updating worldmap
+        self.roll_max = 0.5 #-- Maximum roll for updating worldmap
+        self.home = None #-- Hold the home position of the rover
+        self.sample_count = 0 #-- Keep track of the number of samples collected
+        self.target_yaw = 0 #-- Holds the desired yaw angle
+        self.brake_nom = 0.5 #-- Nominal brake value
+        self.dist_home = 0 #-- Distance to home position
+        self.nav_close = 40 #-- The distance from the rover that is looked at when determining steering angle
+        self.home_prox = 11 #-- Proximity to home location at which to transition to go_home state
+        self.target_angle = 0 #-- angle to the rock sample
+        self.obs_stuck = False #-- Flag if stuck directly behind an obstacle
+        self.debug = False #-- debug flag. Set to True to display debug telemetry to console
+        self.perception_scale = 1 #-- Run perception at 1/perception_scale resolution (1, 2 or 4). Pixel counts stay in full resolution pixels
+        self.perception_range = None #-- Only perceive terrain within this many meters of the rover (at least nav_close). None for the whole field of view. Whole-view pixel counts are lower, see perception.check_perception_range
+        #-- Opt-in temporal subsampling of world map updates (see perception.map_update_due), off by default:
+        #-- it costs some coverage (Mapped 11.4% -> 11.1% on test_dataset with map_max_skip = 10)
+        self.map_min_move = 0.1 #-- Skip world map updates until the rover has moved this many meters...
+        self.map_min_turn = 2.0 #-- ...or turned this many degrees since the last update...
+        self.map_max_skip = 0 #-- ...or this many frames were skipped. 0 updates the map on every frame
+        self.map_pose = None #-- Pose (x, y, yaw) of the last world map update
+        self.map_skipped = 0 #-- Frames skipped since the last world map update
+        self.map_cache = WorldCellCache() #-- World cells of recent poses, reused while standing still or turning in place. None to disable
+        self.profiler = NULL_PROFILER #-- Stage timer (see profiling.py). Set to a StageProfiler to time each processing stage
+
+    #-- Back to the initial state: mode START, a new empty map of the same resolution and default parameters
+    def reset(self):
+        self.__init__(self.worldmap.cells_per_meter)
+
+    #-- Independent deep copy, including the map. The ground truth map is constant and shared
+    def clone(self):
+        return copy.deepcopy(self, {id(self.ground_truth): self.ground_truth})
+
+    #-- Cheap copy of the per-frame state (pose, commands, mode, images, pixel data) for
+    #-- recording, replay and batching. The map and the objects built on it (worldmap,
+    #-- map_stats, frontiers, rock_tracker, home_planner) are shared with this rover, not copied. Images are copied since they are updated in place
+    def snapshot(self):
+        state = RoverState.__new__(RoverState)
+        for name in RoverState.__slots__:
+            setattr(state, name, getattr(self, name))
+        if self.img is not None:
+            state.img = self.img.copy()
+        state.vision_image = self.vision_image.copy()
+        return state
+
+    #-- Memory footprint in bytes of the arrays held by the rover (images, pixel data and map)
+    def nbytes(self):
+        total = self.worldmap.nbytes()
+        for name in ('img', 'vision_image'):
+            value = getattr(self, name)
+            if isinstance(value, np.ndarray):
+                total += value.nbytes
+        for view in (self.nav_view, self.rock_view, self.obs_view):
+            total += view.nbytes()
+        return total
+
+    #-- Full arrays of the pixel polar coordinates, for code that still reads them directly.
+    #-- decision_step uses the views' aggregate accessors instead
+    @property
+    def nav_angles(self):
+        return self.nav_view.angles()
+
+    @property
+    def nav_dists(self):
+        return self.nav_view.dists()
+
+    @property
+    def rock_angles(self):
+        return self.rock_view.angles()
+
+    @property
+    def rock_dists(self):
+        return self.rock_view.dists()
+
+    @property
+    def obs_angles(self):
+        return self.obs_view.angles()
+
+    @property
+    def obs_dists(self):
+        return self.obs_view.dists()
@@ -0,0 +1,384 @@
+#-- Local stand-in for the Unity simulator, for headless closed-loop load testing of drive_rover.py.
+#-- Connects to the Socket.IO server on port 4567 like the simulator does and sends telemetry
+#-- events from one of two sources:
+#--   - a recorded run (robot_log.csv + IMG/, or a frame store from drive_rover.py --capture),
+#--     replayed open loop: the commands sent back are recorded but don't move the rover
+#--   - a synthetic world built from calibration_images/map_bw.png: camera frames are rendered
+#--     from the ground truth map at the pose of a simple kinematic rover model, which is
+#--     driven by the commands sent back, so the loop is closed
+#-- Frames are sent at --rate frames per second, or in lockstep as fast as the server answers
+#-- with --rate 0. The kinematic model advances a fixed 1/--sim_fps seconds per frame, so a
+#-- synthetic lockstep run is deterministic whatever the server speed.
+#-- Reports the end-to-end command latency (telemetry sent -> commands received) percentiles,
+#-- frames dropped because too many were still waiting for commands, and frames never answered.
+#--
+#-- Example: $ python drive_rover.py &
+#--          $ python sim_client.py --synthetic --frames 2000 --rate 0
+#--          $ python sim_client.py --source ../test_dataset/robot_log.csv --rate 25
+#-- Needs the Socket.IO client extras: pip install "python-socketio[client]"
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+import socketio
+
+from perception import calibration_points, PIXELS_PER_METER
+from replay import read_log, resolve_image_path, log_float
+from framestore import FrameStoreReader, is_frame_store
+from rover_state import ground_truth
+from profiling import StageProfiler
+
+#-- Camera image shape of the simulator
+CAMERA_SHAPE = (160, 320, 3)
+#-- Colors the synthetic camera renders terrain, obstacles, rock samples and the sky with.
+#-- Chosen inside NAV_THRESH, OBS_THRESH and ROCK_THRESH of perception.py respectively,
+#-- and the sky inside none of them
+NAV_COLOR = (200, 180, 170)
+OBS_COLOR = (40, 30, 25)
+ROCK_COLOR = (210, 160, 30)
+SKY_COLOR = (110, 130, 150)
+#-- Map pixels per meter of the rendered world, so rocks smaller than a map cell can be drawn
+RENDER_SCALE = 10
+#-- Farthest ground distance (m) drawn by the synthetic camera. Beyond it is sky
+MAX_RANGE = 20
+#-- Start pose (x, y, yaw) of the simulator's rover
+START_POSE = (99.67, 85.59, 56.83)
+
+#-- Number formatting of the simulator telemetry
+def _format(value):
+    return str(float(value))
+
+#-- Telemetry event in the simulator's format. pose and fields are numbers, jpeg the raw JPEG bytes
+def telemetry_message(vel, pos, yaw, pitch, roll, throttle, steer, near_sample, picking_up,
+                      samples_remaining, jpeg, samples_pos):
+    return {'speed': _format(vel), 'position': '{};{}'.format(_format(pos[0]), _format(pos[1])),
+            'yaw': _format(yaw), 'pitch': _format(pitch), 'roll': _format(roll),
+            'throttle': _format(throttle), 'steering_angle': _format(steer),
+            'near_sample': str(int(near_sample)), 'picking_up': str(int(picking_up)),
+            'sample_count': str(int(samples_remaining)),
+            'samples_x': ';'.join(_format(x) for x in samples_pos[0]),
+            'samples_y': ';'.join(_format(y) for y in samples_pos[1]),
+            'image': base64.b64encode(jpeg).decode('ascii')}
+
+# Encode an RGB image as a JPEG
+def encode_jpeg(img):
+    ok, jpeg = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+    return jpeg.tobytes()
+
+#-- Rock sample positions (x array, y array) on navigable ground truth cells next to obstacles,
+#-- where the simulator places them. Seeded, so runs are repeatable
+def sample_positions(n_samples=6, seed=0):
+    navigable = (ground_truth > 0).astype(np.uint8)
+    edge = (navigable > 0) & (cv2.erode(navigable, np.ones((3, 3), np.uint8)) == 0)
+    ys, xs = np.nonzero(edge)
+    picks = np.random.RandomState(seed).choice(len(xs), n_samples, replace=False)
+    return xs[picks] + 0.5, ys[picks] + 0.5
+
+#-- Recorded run replayed open loop. Messages are encoded up front, so sending a frame
+#-- costs the client nothing. Frames are repeated from the start once the run is over.
+#-- Logs don't record the sample positions, so synthetic ones are sent with them
+class ReplaySource():
+    def __init__(self, path, limit=None):
+        self.messages = []
+        if is_frame_store(path):
+            store = FrameStoreReader(path)
+            samples = store.samples or sample_positions()
+            for telemetry in store:
+                if limit is not None and len(self.messages) >= limit:
+                    break
+                self.messages.append(telemetry_message(
+                    telemetry['vel'], telemetry['pos'], telemetry['yaw'], telemetry['pitch'],
+                    telemetry['roll'], telemetry['throttle'], telemetry['steer'],
+                    telemetry['near_sample'], telemetry['picking_up'], telemetry['samples_remaining'],
+                    encode_jpeg(telemetry['img']), samples))
+        else:
+            log_dir = os.path.dirname(os.path.abspath(path))
+            samples = sample_positions()
+            for row in read_log(path):
+                if limit is not None and len(self.messages) >= limit:
+                    break
+                with open(resolve_image_path(row['Path'], log_dir), 'rb') as f:
+                    jpeg = f.read()
+                self.messages.append(telemetry_message(
+                    log_float(row['Speed']), (log_float(row['X_Position']), log_float(row['Y_Position'])),
+                    log_float(row['Yaw']), log_float(row['Pitch']), log_float(row['Roll']),
+                    log_float(row['Throttle']), log_float(row['SteerAngle']), 0, 0, len(samples[0]), jpeg, samples))
+        if not self.messages:
+            raise ValueError('No frames in {}'.format(path))
+        self.frame = 0
+
+    def next_message(self, commands, pickup):
+        message = self.messages[self.frame % len(self.messages)]
+        self.frame += 1
+        return message
+
+#-- Ground coordinates seen by each camera pixel.
+#-- The perception perspective transform maps camera pixels to the warped top-down image,
+#-- PIXELS_PER_METER pixels per meter with the rover at the center bottom. Its forward mapping
+#-- gives the rover-centric position (x forward, y left, in meters) of the ground seen by every
+#-- camera pixel below the horizon, so a frame is rendered with one remap of the world map.
+class CameraModel():
+    def __init__(self, shape=CAMERA_SHAPE, max_range=MAX_RANGE):
+        rows, cols = shape[0], shape[1]
+        self.shape = (rows, cols)
+        source, destination = calibration_points(shape)
+        M = cv2.getPerspectiveTransform(source, destination)
+        us, vs = np.meshgrid(np.arange(cols, dtype=np.float64), np.arange(rows, dtype=np.float64))
+        w = M[2,0]*us + M[2,1]*vs + M[2,2]
+        # Below the horizon w has the sign it has at the bottom of the image
+        ground = (w * w[-1, cols // 2]) > 0
+        w[~ground] = 1
+        x_warped = (M[0,0]*us + M[0,1]*vs + M[0,2]) / w
+        y_warped = (M[1,0]*us + M[1,1]*vs + M[1,2]) / w
+        # Same rover-centric reference as rover_coords
+        self.x = ((rows - y_warped) / PIXELS_PER_METER).astype(np.float32)
+        self.y = ((rows - x_warped) / PIXELS_PER_METER).astype(np.float32)
+        self.sky = ~(ground & (self.x > 0) & (np.hypot(self.x, self.y) < max_range))
+
+    #-- Render the camera image at pos (meters) and yaw (degrees) from a world image of
+    #-- `scale` pixels per meter, indexed [y, x]
+    def render(self, world_img, pos, yaw, scale):
+        yaw_rad = yaw * np.pi / 180
+        cos_yaw, sin_yaw = np.cos(yaw_rad), np.sin(yaw_rad)
+        map_x = ((pos[0] + cos_yaw * self.x - sin_yaw * self.y) * scale).astype(np.float32)
+        map_y = ((pos[1] + sin_yaw * self.x + cos_yaw * self.y) * scale).astype(np.float32)
+        img = cv2.remap(world_img, map_x, map_y, cv2.INTER_NEAREST,
+                        borderMode=cv2.BORDER_CONSTANT, borderValue=OBS_COLOR)
+        img[self.sky] = SKY_COLOR
+        return img
+
+#-- Kinematic rover model driven by the commands of drive_rover.py.
+#-- Throttle accelerates, brake and drag decelerate, steering turns the rover like a
+#-- bicycle when moving and turns it on the spot when stopped with the brake released,
+#-- as the simulator's rover does. The rover stops dead when driving into an obstacle cell
+class KinematicRover():
+    def __init__(self, pos, yaw, navigable, accel=2.0, brake_decel=10.0, drag=0.2, max_vel=5.0,
+                 wheelbase=1.5, spin_rate=3.0):
+        self.pos = np.array(pos, dtype=np.float64)
+        self.yaw = yaw
+        self.vel = 0.0
+        self.navigable = navigable # Boolean ground truth map, indexed [y, x], 1 cell per meter
+        self.accel = accel # m/s^2 at full throttle
+        self.brake_decel = brake_decel # m/s^2 per unit of brake
+        self.drag = drag # Fraction of the velocity lost per second
+        self.max_vel = max_vel
+        self.wheelbase = wheelbase
+        self.spin_rate = spin_rate # deg/s of turning on the spot per degree of steering
+
+    def _navigable(self, pos):
+        x, y = int(np.floor(pos[0])), int(np.floor(pos[1]))
+        rows, cols = self.navigable.shape
+        return 0 <= x < cols and 0 <= y < rows and self.navigable[y, x]
+
+    #-- Advance the model by dt seconds under commands (throttle, brake, steer)
+    def step(self, commands, dt):
+        throttle, brake, steer = commands
+        vel = self.vel + (throttle * self.accel - self.drag * self.vel) * dt
+        if brake > 0:
+            decel = min(abs(vel), brake * self.brake_decel * dt)
+            vel -= np.sign(vel) * decel
+        self.vel = float(np.clip(vel, -self.max_vel, self.max_vel))
+        if abs(self.vel) < 0.05 and brake == 0:
+            self.yaw += steer * self.spin_rate * dt
+        else:
+            self.yaw += np.degrees(self.vel / self.wheelbase * np.tan(np.radians(steer))) * dt
+        self.yaw %= 360
+        yaw_rad = np.radians(self.yaw)
+        pos = self.pos + self.vel * dt * np.array([np.cos(yaw_rad), np.sin(yaw_rad)])
+        if self._navigable(pos):
+            self.pos = pos
+        else:
+            self.vel = 0.0
+
+#-- Synthetic world: camera frames are rendered from the ground truth map at the pose of a
+#-- KinematicRover driven by the commands received. Rock samples are placed on navigable cells
+#-- next to obstacles (seeded, so runs are repeatable) and are picked up as in the simulator
+class SyntheticSource():
+    def __init__(self, n_samples=6, seed=0, start=START_POSE, sim_fps=25, near_dist=1.5,
+                 pickup_frames=25, rock_radius=0.3):
+        navigable = ground_truth > 0
+        self.dt = 1.0 / sim_fps
+        self.near_dist = near_dist
+        self.pickup_frames = pickup_frames
+        self.rover = KinematicRover(start[:2], start[2], navigable)
+        self.camera = CameraModel()
+        self.samples_pos = sample_positions(n_samples, seed)
+        self.collected = np.zeros(n_samples, dtype=bool)
+        self.picking_up = 0 # Frames left of the current pickup
+        # World image, RENDER_SCALE pixels per meter
+        world = np.where(navigable[:, :, None], NAV_COLOR, OBS_COLOR).astype(np.uint8)
+        self.world = cv2.resize(world, None, fx=RENDER_SCALE, fy=RENDER_SCALE,
+                                interpolation=cv2.INTER_NEAREST)
+        for x, y in zip(*self.samples_pos):
+            cv2.circle(self.world, (int(x * RENDER_SCALE), int(y * RENDER_SCALE)),
+                       int(np.ceil(rock_radius * RENDER_SCALE)), ROCK_COLOR, -1)
+
+    #-- Index of the uncollected sample within near_dist of the rover, or None
+    def _near_sample(self):
+        dists = np.hypot(self.samples_pos[0] - self.rover.pos[0], self.samples_pos[1] - self.rover.pos[1])
+        dists[self.collected] = np.inf
+        i = int(np.argmin(dists))
+        return i if dists[i] < self.near_dist else None
+
+    def _collect(self, i):
+        self.collected[i] = True
+        x, y = self.samples_pos[0][i], self.samples_pos[1][i]
+        color = NAV_COLOR if ground_truth[int(y), int(x)] else OBS_COLOR
+        cv2.circle(self.world, (int(x * RENDER_SCALE), int(y * RENDER_SCALE)),
+                   int(np.ceil(0.5 * RENDER_SCALE)), color, -1)
+
+    #-- Apply the latest commands (and pickup request), advance the model one frame and
+    #-- return the next telemetry event
+    def next_message(self, commands, pickup):
+        rover = self.rover
+        if self.picking_up > 0:
+            self.picking_up -= 1
+            if self.picking_up == 0:
+                i = self._near_sample()
+                if i is not None:
+                    self._collect(i)
+            rover.step((0, 1, 0), self.dt)
+        else:
+            if pickup and self._near_sample() is not None and abs(rover.vel) < 0.05:
+                self.picking_up = self.pickup_frames
+            rover.step(commands, self.dt)
+        img = self.camera.render(self.world, rover.pos, rover.yaw, RENDER_SCALE)
+        return telemetry_message(rover.vel, rover.pos, rover.yaw, 0, 0, commands[0], commands[2],
+                                 self._near_sample() is not None, self.picking_up > 0,
+                                 np.count_nonzero(~self.collected), encode_jpeg(img), self.samples_pos)
+
+#-- Socket.IO client standing in for the simulator.
+#-- Commands come back from drive_rover.py in the order the telemetry events were sent,
+#-- so each 'data' event is matched to the oldest frame still waiting for commands
+class LoadClient():
+    def __init__(self, url='http://localhost:4567', max_in_flight=1, timeout=5.0):
+        self.url = url
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.profiler = StageProfiler(capacity=100000)
+        self.commands = (0.0, 0.0, 0.0) # Latest throttle, brake, steer received
+        self.pickup = False # Pickup requested since the last frame
+        self.sent = 0
+        self.answered = 0
+        self.dropped = 0 # Frames not sent because max_in_flight frames were waiting for commands
+        self.lost = 0 # Frames never answered within timeout
+        self._waiting = deque() # Send times of the frames waiting for commands
+        self._cond = threading.Condition()
+        self._connected = False
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('connect', self._on_connect)
+        self.sio.on('data', self._on_data)
+        self.sio.on('pickup', self._on_pickup)
+
+    def _on_connect(self):
+        with self._cond:
+            self._connected = True
+            self._cond.notify_all()
+
+    def _on_data(self, data):
+        with self._cond:
+            self.commands = (float(data['throttle']), float(data['brake']), float(data['steering_angle']))
+            if self._waiting:
+                self.profiler.toc('command_latency', self._waiting.popleft())
+                self.answered += 1
+            self._cond.notify_all()
+
+    def _on_pickup(self, data):
+        self.pickup = True
+
+    #-- Send `frames` frames from source at `rate` frames per second (0 for lockstep) and
+    #-- return the run statistics
+    def run(self, source, frames, rate=0):
+        self.sio.connect(self.url, transports=['websocket'])
+        # drive_rover.py answers the connection with null commands. Let them arrive first
+        # so they aren't mistaken for the answer to the first frame
+        time.sleep(0.5)
+        with self._cond:
+            self._waiting.clear()
+        period = 1.0 / rate if rate > 0 else 0
+        t0 = next_time = time.perf_counter()
+        for frame in range(frames):
+            with self._cond:
+                if rate <= 0:
+                    # Lockstep: wait for the commands of the previous frame
+                    if not self._cond.wait_for(lambda: len(self._waiting) == 0, self.timeout):
+                        self.lost += len(self._waiting)
+                        self._waiting.clear()
+                elif len(self._waiting) >= self.max_in_flight:
+                    # Still waiting for earlier commands: the simulator renders on and this frame is dropped
+                    self.dropped += 1
+                    self._expire()
+                    next_time = self._sleep_until(next_time + period)
+                    continue
+                commands, pickup = self.commands, self.pickup
+                self.pickup = False
+            message = source.next_message(commands, pickup)
+            with self._cond:
+                self._waiting.append(time.perf_counter())
+            self.sio.emit('telemetry', message)
+            self.sent += 1
+            if rate > 0:
+                next_time = self._sleep_until(next_time + period)
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._waiting) == 0, self.timeout)
+            self.lost += len(self._waiting)
+            self._waiting.clear()
+        elapsed = time.perf_counter() - t0
+        self.sio.disconnect()
+        return self.stats(elapsed)
+
+    #-- Give up on frames waiting for longer than timeout. Call with the lock held
+    def _expire(self):
+        now = time.perf_counter()
+        while self._waiting and now - self._waiting[0] > self.timeout:
+            self._waiting.popleft()
+            self.lost += 1
+
+    def _sleep_until(self, next_time):
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        return next_time
+
+    def stats(self, elapsed):
+        stats = {'sent': self.sent, 'answered': self.answered, 'dropped': self.dropped,
+                 'lost': self.lost, 'elapsed': elapsed, 'fps': self.answered / max(elapsed, 1e-9)}
+        stats.update(self.profiler.summary().get('command_latency', {}))
+        return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulator stand-in for load testing drive_rover.py')
+    parser.add_argument('--source', type=str, default='../test_dataset/robot_log.csv',
+                        help='robot_log.csv or frame store folder to replay.')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='Render frames from the ground truth map with a kinematic rover instead of replaying.')
+    parser.add_argument('--frames', type=int, default=1000, help='Number of frames to send.')
+    parser.add_argument('--rate', type=float, default=25,
+                        help='Frames per second to send. 0 sends each frame as soon as the previous one is answered.')
+    parser.add_argument('--max_in_flight', type=int, default=1,
+                        help='Frames that may wait for commands before further frames are dropped (with --rate).')
+    parser.add_argument('--timeout', type=float, default=5.0, help='Seconds before a frame counts as lost.')
+    parser.add_argument('--sim_fps', type=float, default=25, help='Simulated frames per second of the kinematic model.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic rock sample positions.')
+    parser.add_argument('--url', type=str, default='http://localhost:4567', help='drive_rover.py server.')
+    parser.add_argument('--stats_file', type=str, default='', help='Also write the statistics to this JSON file.')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        source = SyntheticSource(seed=args.seed, sim_fps=args.sim_fps)
+    else:
+        source = ReplaySource(args.source, limit=args.frames)
+    client = LoadClient(args.url, args.max_in_flight, args.timeout)
+    stats = client.run(source, args.frames, args.rate)
+    print('Sent {sent} frames in {elapsed:.1f} s, {answered} answered ({fps:.1f} frames/s), '
+          '{dropped} dropped, {lost} lost'.format(**stats))
+    print(client.profiler.report())
+    if args.stats_file != '':
+        with open(args.stats_file, 'w') as f:
+            json.dump(stats, f, indent=2)
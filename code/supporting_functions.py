@@ -4,24 +4,67 @@ from PIL import Image
 from io import BytesIO, StringIO
 import base64
 import time
+import threading
 
-# Define a function to convert telemetry strings to float independent of decimal convention
-def convert_to_float(string_to_convert):
-      if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
-      else: 
-            float_value = np.float(string_to_convert)
-      return float_value
+from worldmap import NAVIGABLE, OBSTACLE, key_coords
+
+#-- Telemetry fields parsed as floats, and the RoverState attribute each one is stored in
+TELEMETRY_FLOATS = (("speed", "vel"), ("yaw", "yaw"), ("pitch", "pitch"), ("roll", "roll"),
+                    ("throttle", "throttle"), ("steering_angle", "steer"))
+#-- Telemetry fields parsed as integer flags/counts. The telemetry sample_count is the number of
+#-- samples still to collect, not RoverState.sample_count (samples collected), so it is decoded
+#-- as samples_remaining
+TELEMETRY_INTS = (("near_sample", "near_sample"), ("picking_up", "picking_up"),
+                  ("sample_count", "samples_remaining"))
+
+#-- Decodes telemetry events in a single pass.
+#-- Every numeric field is parsed with one float()/int() call and the camera frame is
+#-- decoded with cv2.imdecode straight from the base64 payload, then converted to RGB
+#-- into a reusable buffer. Set reuse_buffer to False if decoded images must outlive the next frame.
+class TelemetryDecoder():
+      def __init__(self, reuse_buffer=True):
+            self.reuse_buffer = reuse_buffer
+            self.img = None # Last decoded RGB camera image
+            self.jpeg = None # Raw JPEG bytes of the last camera image
+            self.telemetry = None # Last decoded telemetry dict
+
+      #-- Returns a dict of the parsed telemetry, keyed by RoverState attribute name (and samples_remaining)
+      def decode(self, data):
+            telemetry = {name: float(data[key].replace(',','.')) for key, name in TELEMETRY_FLOATS}
+            for key, name in TELEMETRY_INTS:
+                  telemetry[name] = int(data[key])
+            telemetry["pos"] = [float(pos) for pos in data["position"].replace(',','.').split(';')]
+            telemetry["img"] = self.decode_image(data["image"])
+            self.telemetry = telemetry
+            return telemetry
+
+      #-- Known sample positions, only sent meaningfully on the first telemetry event
+      def decode_samples(self, data):
+            samples_xpos = np.int_([float(pos) for pos in data["samples_x"].replace(',','.').split(';')])
+            samples_ypos = np.int_([float(pos) for pos in data["samples_y"].replace(',','.').split(';')])
+            return samples_xpos, samples_ypos
+
+      def decode_image(self, img_string):
+            self.jpeg = base64.b64decode(img_string)
+            bgr = cv2.imdecode(np.frombuffer(self.jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if not self.reuse_buffer or self.img is None or self.img.shape != bgr.shape:
+                  self.img = np.empty_like(bgr)
+            return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=self.img)
+
+#-- Decoder used by update_rover. Rover.img is overwritten in place on every frame
+telemetry_decoder = TelemetryDecoder()
 
 def update_rover(Rover, data):
+      # Parse all the telemetry fields and decode the camera image
+      telemetry = telemetry_decoder.decode(data)
       # Initialize start time and sample positions
       if Rover.start_time == None:
             Rover.start_time = time.time()
             Rover.total_time = 0
-            samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
-            samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
-            Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
+            Rover.samples_pos = telemetry_decoder.decode_samples(data)
+            Rover.rock_tracker = RockTracker(Rover.samples_pos, Rover.ground_truth.shape,
+                                             Rover.worldmap.cells_per_meter)
+            Rover.samples_to_find = telemetry["samples_remaining"]
       # Or just update elapsed time
       else:
             tot_time = time.time() - Rover.start_time
@@ -30,25 +73,25 @@ def update_rover(Rover, data):
       # Print out the fields in the telemetry data dictionary
       #print(data.keys())
       # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
+      Rover.vel = telemetry["vel"]
       # The current position of the rover
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
-      # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
-      # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
+      Rover.pos = telemetry["pos"]
       # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
+      Rover.yaw = telemetry["yaw"]
+      # The current pitch angle of the rover
+      Rover.pitch = telemetry["pitch"]
+      # The current roll angle of the rover
+      Rover.roll = telemetry["roll"]
       # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
+      Rover.throttle = telemetry["throttle"]
       # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
+      Rover.steer = telemetry["steer"]
       # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
+      Rover.near_sample = telemetry["near_sample"]
       # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
+      Rover.picking_up = telemetry["picking_up"]
       # Update number of rocks found
-      Rover.samples_found = Rover.samples_to_find - np.int(data["sample_count"])
+      Rover.samples_found = Rover.samples_to_find - telemetry["samples_remaining"]
       
       #-- Different telemetry outputs depending on what needs to be seen. Uncomment as required
       #-- Only displays if debug flag is set
@@ -70,74 +113,122 @@ def update_rover(Rover, data):
             #print ('mode =', Rover.mode, end = '\n')
       
       # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
+      Rover.img = telemetry["img"]
 
-      # Return updated Rover and separate image for optional saving
-      return Rover, image
+      # Return updated Rover and the raw JPEG of the image for optional saving
+      return Rover, telemetry_decoder.jpeg
 
-# Define a function to create display output given worldmap results
-def create_output_images(Rover):
+#-- Map statistics and plot map for create_output_images, maintained incrementally.
+#-- perception_step passes in the world cells touched each frame, so the "Mapped" and
+#-- "Fidelity" counters and the plot map only cost O(cells changed this frame)
+#-- instead of several rescans of the whole worldmap on every frame.
+class MapStats():
+      def __init__(self, ground_truth):
+            self.shape = ground_truth.shape[:2]
+            # Ground truth navigable terrain, flattened to cell indices
+            self.truth = ground_truth[:,:,1].ravel() > 0
+            # Grab the total number of map pixels
+            self.tot_map_pix = float(np.count_nonzero(self.truth))
+            # Last known state of every cell (UNKNOWN, NAVIGABLE or OBSTACLE)
+            self.state = np.zeros(self.truth.shape, dtype=np.int8)
+            # Total number of navigable terrain map pixels and how many correspond to ground truth pixels
+            self.tot_nav_pix = 0
+            self.good_nav_pix = 0
+            # Obstacle and navigable terrain map overlaid with ground truth map
+            self.map_add = cv2.addWeighted(np.zeros_like(ground_truth), 1, ground_truth, 0.5, 0)
+            self._map_cells = self.map_add.reshape(-1, 3)
 
-      # Create a scaled map for plotting and clean up obs/nav pixels a bit
-      if np.max(Rover.worldmap[:,:,2]) > 0:
-            nav_pix = Rover.worldmap[:,:,2] > 0
-            navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-      else: 
-            navigable = Rover.worldmap[:,:,2]
-      if np.max(Rover.worldmap[:,:,0]) > 0:
-            obs_pix = Rover.worldmap[:,:,0] > 0
-            obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
-      else:
-            obstacle = Rover.worldmap[:,:,0]
-
-      likely_nav = navigable >= obstacle
-      obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
-      plotmap[:, :, 0] = obstacle
-      plotmap[:, :, 2] = navigable
-      plotmap = plotmap.clip(0, 255)
-      # Overlay obstacle and navigable terrain map with ground truth map
-      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
-
-      # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-      # If there are, we'll step through the known sample positions
-      # to confirm whether detections are real
-      if rock_world_pos[0].any():
+      #-- Update with the worldmap cells touched this frame.
+      #-- The statistics are kept at the 1m resolution of the ground truth map: a ground truth
+      #-- cell counts as navigable if any of the worldmap cells inside it is navigable
+      def update(self, worldmap, touched):
+            factor = worldmap.cells_per_meter
+            rows, cols = self.shape
+            x_cell, y_cell = key_coords(touched)
+            x_cell, y_cell = x_cell // factor, y_cell // factor
+            inside = (x_cell >= 0) & (x_cell < cols) & (y_cell >= 0) & (y_cell < rows)
+            touched = np.unique(y_cell[inside] * cols + x_cell[inside])
+            state = worldmap.coarse_state(touched % cols, touched // cols, factor)
+            changed = state != self.state[touched]
+            if not changed.any():
+                  return
+            cells = touched[changed]
+            state = state[changed]
+            was_nav = self.state[cells] == NAVIGABLE
+            is_nav = state == NAVIGABLE
+            truth = self.truth[cells]
+            self.tot_nav_pix += int(np.count_nonzero(is_nav)) - int(np.count_nonzero(was_nav))
+            self.good_nav_pix += int(np.count_nonzero(is_nav & truth)) - int(np.count_nonzero(was_nav & truth))
+            self.state[cells] = state
+            # Obstacles on the RED layer and navigable terrain on the BLUE layer
+            self._map_cells[cells, 0] = np.where(state == OBSTACLE, 255, 0)
+            self._map_cells[cells, 2] = np.where(is_nav, 255, 0)
+
+      # Calculate the percentage of ground truth map that has been successfully found
+      def perc_mapped(self):
+            return round(100*self.good_nav_pix/self.tot_map_pix, 1)
+
+      # Calculate the number of good map pixel detections divided by total pixels
+      # found to be navigable terrain
+      def fidelity(self):
+            if self.tot_nav_pix > 0:
+                  return round(100*self.good_nav_pix/self.tot_nav_pix, 1)
+            else:
+                  return 0
+
+#-- Confirms rock sample detections against the known sample positions.
+#-- For every world cell a lookup grid holds which samples are within the confirmation
+#-- distance of it, so checking the rock cells detected in a frame is a single lookup.
+#-- Confirmed samples are cached and never evaluated again.
+class RockTracker():
+      def __init__(self, samples_pos, shape, cells_per_meter=1, max_dist=3):
+            self.samples_pos = samples_pos
+            self.shape = shape[:2]
+            self.cells_per_meter = cells_per_meter
+            rows, cols = self.shape
+            self.confirmed = np.zeros(len(samples_pos[0]), dtype=bool)
+            ypos, xpos = np.mgrid[0:rows, 0:cols]
+            # near[cell, idx] is True if the cell is within max_dist of sample idx
+            self.near = np.zeros((rows*cols, len(samples_pos[0])), dtype=bool)
+            for idx in range(len(samples_pos[0])):
+                  rock_sample_dists = np.sqrt((samples_pos[0][idx] - xpos)**2 + \
+                                              (samples_pos[1][idx] - ypos)**2)
+                  self.near[:, idx] = rock_sample_dists.ravel() < max_dist
+
+      #-- Update with the rock cells (worldmap cell keys) seen this frame
+      def update(self, rock_cells):
+            if len(rock_cells) == 0 or self.confirmed.all():
+                  return
+            rows, cols = self.shape
+            x_cell, y_cell = key_coords(rock_cells)
+            x_cell, y_cell = x_cell // self.cells_per_meter, y_cell // self.cells_per_meter
+            inside = (x_cell >= 0) & (x_cell < cols) & (y_cell >= 0) & (y_cell < rows)
+            self.confirmed |= self.near[y_cell[inside] * cols + x_cell[inside]].any(axis=0)
+
+#-- Render the map and vision images for display, without encoding them.
+#-- Returns new uint8 arrays, so they can be encoded while the Rover keeps updating
+def render_output_images(Rover):
+
+      #-- The plot map and statistics are kept up to date by perception_step through Rover.map_stats.
+      #-- Copy the overlay since the rock samples and text are drawn on top of it
+      map_add = Rover.map_stats.map_add.copy()
+
+      #-- Samples are confirmed as rocks are detected within 3 meters of them (see RockTracker).
+      #-- Plot the location of each confirmed sample on the map
+      if Rover.rock_tracker is not None:
             rock_size = 2
-            for idx in range(len(Rover.samples_pos[0])):
+            for idx in np.flatnonzero(Rover.rock_tracker.confirmed):
                   test_rock_x = Rover.samples_pos[0][idx]
                   test_rock_y = Rover.samples_pos[1][idx]
-                  rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                        (test_rock_y - rock_world_pos[0])**2)
-                  # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
-                  if np.min(rock_sample_dists) < 3:
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+                  map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
+                  test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
 
       # Calculate some statistics on the map results
-      # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
-      # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
-      # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
-      # Calculate the percentage of ground truth map that has been successfully found
-      perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
-      # Calculate the number of good map pixel detections divided by total pixels 
-      # found to be navigable terrain
-      if tot_nav_pix > 0:
-            fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
-      else:
-            fidelity = 0
+      perc_mapped = Rover.map_stats.perc_mapped()
+      fidelity = Rover.map_stats.fidelity()
       # Flip the map for plotting so that the y-axis points upward in the display
-      map_add = np.flipud(map_add).astype(np.float32)
+      #-- Converted to uint8 before drawing the text, which recent OpenCV versions require
+      map_add = np.flipud(map_add).astype(np.uint8)
       # Add some text about map and rock sample detection results
       cv2.putText(map_add,"Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -150,18 +241,82 @@ def create_output_images(Rover):
       cv2.putText(map_add,"Taariq Hassan", (0, 190), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
 
-      # Convert map and vision image to base64 strings for sending to server
-      pil_img = Image.fromarray(map_add.astype(np.uint8))
+      return map_add, Rover.vision_image.astype(np.uint8)
+
+# Convert map and vision image to base64 strings for sending to server
+def encode_output_images(map_img, vision_img):
+      pil_img = Image.fromarray(map_img)
       buff = BytesIO()
       pil_img.save(buff, format="JPEG")
       encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
       
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
+      pil_img = Image.fromarray(vision_img)
       buff = BytesIO()
       pil_img.save(buff, format="JPEG")
       encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
 
       return encoded_string1, encoded_string2
 
+# Define a function to create display output given worldmap results
+def create_output_images(Rover):
+      map_img, vision_img = render_output_images(Rover)
+      return encode_output_images(map_img, vision_img)
+
+#-- Encodes the inset images on a worker thread so that sending commands to the rover
+#-- never waits for JPEG/base64 encoding. Images are rendered and submitted every
+#-- `every` frames, and at most once per `period` seconds. Only the newest submitted
+#-- frame is kept: if the encoder falls behind, older frames are dropped.
+class InsetEncoder():
+      def __init__(self, every=1, period=0):
+            self.every = max(1, every)
+            self.period = period
+            self.frame_count = 0 # Frames seen since the last submission
+            self.last_submit = 0 # Time of the last submission
+            self.dropped = 0 # Frames dropped because the encoder was busy
+            self.encoded = ('', '') # Most recent encoded images
+            self._pending = None
+            self._cond = threading.Condition()
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='InsetEncoder')
+            self._thread.daemon = True
+            self._thread.start()
+
+      #-- Call once per frame. True if this frame's images should be rendered and submitted
+      def due(self):
+            self.frame_count += 1
+            if self.frame_count < self.every:
+                  return False
+            if self.period > 0 and (time.time() - self.last_submit) < self.period:
+                  return False
+            self.frame_count = 0
+            self.last_submit = time.time()
+            return True
+
+      #-- Hand rendered images to the worker, replacing any frame still waiting
+      def submit(self, map_img, vision_img):
+            with self._cond:
+                  if self._pending is not None:
+                        self.dropped += 1
+                  self._pending = (map_img, vision_img)
+                  self._cond.notify()
+
+      #-- Most recent encoded images (empty strings until the first frame is encoded)
+      def latest(self):
+            return self.encoded
 
+      def close(self):
+            with self._cond:
+                  self._running = False
+                  self._cond.notify()
+            self._thread.join()
 
+      def _run(self):
+            while True:
+                  with self._cond:
+                        while self._pending is None and self._running:
+                              self._cond.wait()
+                        if not self._running:
+                              return
+                        map_img, vision_img = self._pending
+                        self._pending = None
+                  self.encoded = encode_output_images(map_img, vision_img)
@@ -0,0 +1,73 @@
+#-- Tests of the go_home planner. Run from the code folder: $ python -m pytest -q
+import numpy as np
+
+from worldmap import OccupancyGrid, OBSTACLE, cell_keys
+from planner import HomePlanner
+
+HOME = (50.5, 50.5)
+START = (50.5, 30.5)
+
+#-- Map with a wall of obstacles across y = 40 from x = 30 to x = 60, between START and HOME.
+#-- The only way home is around the east end of the wall
+def walled_map():
+    worldmap = OccupancyGrid(cells_per_meter=1)
+    x_wall = np.arange(30, 61)
+    wall = cell_keys(x_wall, np.full(len(x_wall), 40))
+    worldmap.update(wall, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    return worldmap
+
+def blocked(worldmap, pos):
+    key = cell_keys([int(np.floor(pos[0]))], [int(np.floor(pos[1]))])
+    return worldmap.state(key)[0] == OBSTACLE
+
+#-- Drive a point rover from start towards waypoint(pos) in steps of `step` meters.
+#-- Returns the positions visited, ending within 1 m of home or after max_steps
+def follow(waypoint, worldmap, start, step=0.5, max_steps=200):
+    pos = np.array(start, dtype=np.float64)
+    track = [pos.copy()]
+    for i in range(max_steps):
+        if np.hypot(*(pos - HOME)) < 1:
+            break
+        target = np.array(waypoint(pos), dtype=np.float64)
+        delta = target - pos
+        pos = pos + delta * min(1, step / np.hypot(*delta))
+        track.append(pos.copy())
+    return track
+
+def test_straight_line_homing_is_blocked():
+    worldmap = walled_map()
+    track = follow(lambda pos: HOME, worldmap, START)
+    assert any(blocked(worldmap, pos) for pos in track)
+
+def test_planned_route_reaches_home_around_the_wall():
+    worldmap = walled_map()
+    planner = HomePlanner(worldmap, HOME)
+    track = follow(planner.waypoint, worldmap, START)
+    assert np.hypot(*(track[-1] - HOME)) < 1
+    assert not any(blocked(worldmap, pos) for pos in track)
+
+#-- The smoothed route aims past the end of the wall instead of at the next 8-connected cell,
+#-- and heads straight home once home is in line of sight
+def test_waypoints_are_smoothed():
+    worldmap = walled_map()
+    planner = HomePlanner(worldmap, HOME)
+    first = planner.waypoint(START)
+    assert np.hypot(first[0] - START[0], first[1] - START[1]) > 5
+    assert first[0] > 60
+    assert planner.waypoint((62.5, 45.5)) == HOME
+
+#-- Touching cells in the inflation halo of the wall doesn't replan, a new obstacle on the path does
+def test_notify_ignores_inflation():
+    worldmap = walled_map()
+    planner = HomePlanner(worldmap, HOME, inflate=1)
+    planner.waypoint(START)
+    replans = planner.replans
+    x_halo = np.arange(30, 61)
+    planner.notify(cell_keys(x_halo, np.full(len(x_halo), 39)))
+    assert not planner.dirty
+    obstacle = cell_keys([52], [31])
+    worldmap.update(obstacle, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    planner.notify(obstacle)
+    assert planner.dirty
+    planner.waypoint(START)
+    assert planner.replans == replans + 1
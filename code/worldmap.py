@@ -0,0 +1,232 @@
+from collections import OrderedDict
+
+import numpy as np
+
+#-- Cell states returned by OccupancyGrid.state()
+UNKNOWN = 0
+NAVIGABLE = 1
+OBSTACLE = 2
+
+#-- Cell keys pack signed (x, y) cell coordinates into one int64 so that
+#-- a frame's cells can be deduplicated with np.unique
+KEY_BITS = 31
+KEY_OFFSET = 1 << 30
+
+# Define a function to convert world cell x, y coordinates to cell keys
+def cell_keys(x_cell, y_cell):
+    return ((np.asarray(y_cell, dtype=np.int64) + KEY_OFFSET) << KEY_BITS) \
+           | (np.asarray(x_cell, dtype=np.int64) + KEY_OFFSET)
+
+# Define a function to convert cell keys back to world cell x, y coordinates
+def key_coords(keys):
+    keys = np.asarray(keys, dtype=np.int64)
+    return (keys & ((1 << KEY_BITS) - 1)) - KEY_OFFSET, (keys >> KEY_BITS) - KEY_OFFSET
+
+#-- Sorted unique cell keys of world cell x, y coordinates, the same as np.unique(cell_keys(...)).
+#-- The cells of one frame only cover a small window of the map, so they are deduplicated by
+#-- marking them in a boolean array over that window instead of sorting them
+def unique_cell_keys(x_cell, y_cell, max_window=1 << 20):
+    if len(x_cell) == 0:
+        return np.zeros(0, dtype=np.int64)
+    x_cell = np.asarray(x_cell, dtype=np.int64)
+    y_cell = np.asarray(y_cell, dtype=np.int64)
+    x0, y0 = x_cell.min(), y_cell.min()
+    width, height = x_cell.max() - x0 + 1, y_cell.max() - y0 + 1
+    if width * height > max_window:
+        return np.unique(cell_keys(x_cell, y_cell))
+    seen = np.zeros(width * height, dtype=bool)
+    seen[(y_cell - y0) * width + (x_cell - x0)] = True
+    y_local, x_local = np.divmod(np.flatnonzero(seen), width)
+    return cell_keys(x_local + x0, y_local + y0)
+
+#-- Probabilistic occupancy grid world map, stored as lazily allocated square tiles.
+#-- Each cell holds an int16 log-odds value: obstacle observations add obs_hit and
+#-- navigable terrain observations subtract nav_hit, once per cell per frame, saturating
+#-- at +/-limit. A single bad frame therefore only nudges a cell instead of permanently
+#-- marking it. Navigable terrain is weighted above obstacles (like the old
+#-- "navigable >= obstacle" clean up), since obstacle pixels are far more numerous
+#-- and smear across the terrain edges. Rock sample observations are counted in a
+#-- separate saturating layer.
+#-- The map has cells_per_meter cells per world meter and no fixed extent: a tile of
+#-- tile_size x tile_size cells is only allocated once something is observed in it,
+#-- so memory grows with the explored area. Cells are addressed by cell key (see cell_keys).
+class OccupancyGrid():
+    def __init__(self, cells_per_meter=1, tile_size=32, obs_hit=1, nav_hit=2, limit=50, threshold=1):
+        if tile_size & (tile_size - 1):
+            raise ValueError('tile_size must be a power of 2')
+        self.cells_per_meter = cells_per_meter
+        self.tile_size = tile_size
+        self.tile_bits = tile_size.bit_length() - 1
+        self.obs_hit = obs_hit
+        self.nav_hit = nav_hit
+        self.limit = limit # Saturation bound of the log-odds
+        self.threshold = threshold # |log-odds| at which a cell counts as obstacle / navigable
+        #-- (tile_x, tile_y) -> int16 array of shape (2, tile_size*tile_size):
+        #-- row 0 holds the log-odds and row 1 the rock sample counts
+        self.tiles = {}
+
+    #-- Allocated memory in bytes
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    #-- Split cell keys by tile. Yields (tile_x, tile_y, positions in keys, index within the tile)
+    def _by_tile(self, keys):
+        x_cell, y_cell = key_coords(keys)
+        tile_x = x_cell >> self.tile_bits
+        tile_y = y_cell >> self.tile_bits
+        local = ((y_cell & (self.tile_size - 1)) << self.tile_bits) | (x_cell & (self.tile_size - 1))
+        tile_ids, inverse = np.unique(cell_keys(tile_x, tile_y), return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.searchsorted(inverse[order], np.arange(len(tile_ids) + 1))
+        for i in range(len(tile_ids)):
+            positions = order[starts[i]:starts[i + 1]]
+            first = positions[0]
+            yield int(tile_x[first]), int(tile_y[first]), positions, local[positions]
+
+    def _tile(self, tile_x, tile_y):
+        tile = self.tiles.get((tile_x, tile_y))
+        if tile is None:
+            tile = np.zeros((2, self.tile_size * self.tile_size), dtype=np.int16)
+            self.tiles[(tile_x, tile_y)] = tile
+        return tile
+
+    #-- Add the observations of one frame (arrays of cell keys). Set assume_unique if the
+    #-- arrays are already sorted and deduplicated (see unique_cell_keys).
+    #-- Returns the unique cells whose occupancy may have changed
+    def update(self, obs_cells, rock_cells, nav_cells, assume_unique=False):
+        if not assume_unique:
+            obs_cells = np.unique(obs_cells)
+            nav_cells = np.unique(nav_cells)
+            rock_cells = np.unique(rock_cells)
+        touched = np.union1d(obs_cells, nav_cells)
+        if len(touched):
+            delta = np.zeros(len(touched), dtype=np.int32)
+            # Cells are unique within each array, so plain fancy indexing adds once per cell
+            delta[np.searchsorted(touched, obs_cells)] += self.obs_hit
+            delta[np.searchsorted(touched, nav_cells)] -= self.nav_hit
+            for tile_x, tile_y, positions, local in self._by_tile(touched):
+                tile = self._tile(tile_x, tile_y)
+                # Accumulate in int32 then saturate, so the int16 map never wraps
+                logodds = tile[0, local] + delta[positions]
+                tile[0, local] = np.clip(logodds, -self.limit, self.limit)
+        if len(rock_cells):
+            for tile_x, tile_y, positions, local in self._by_tile(rock_cells):
+                tile = self._tile(tile_x, tile_y)
+                tile[1, local] = np.minimum(tile[1, local].astype(np.int32) + 1, np.iinfo(np.int16).max)
+        return touched
+
+    #-- Log-odds and rock counts of the given cells (0 for cells never observed)
+    def values(self, keys):
+        logodds = np.zeros(len(keys), dtype=np.int16)
+        rocks = np.zeros(len(keys), dtype=np.int16)
+        if len(keys):
+            for tile_x, tile_y, positions, local in self._by_tile(keys):
+                tile = self.tiles.get((tile_x, tile_y))
+                if tile is not None:
+                    logodds[positions] = tile[0, local]
+                    rocks[positions] = tile[1, local]
+        return logodds, rocks
+
+    #-- State (UNKNOWN, NAVIGABLE or OBSTACLE) of the given cells
+    def state(self, keys):
+        return self._classify(self.values(keys)[0])
+
+    def _classify(self, logodds):
+        state = np.zeros(logodds.shape, dtype=np.int8)
+        state[logodds <= -self.threshold] = NAVIGABLE
+        state[logodds >= self.threshold] = OBSTACLE
+        return state
+
+    #-- Aggregate state of coarse cells made of factor x factor map cells, given by their
+    #-- coarse x, y coordinates. A coarse cell is navigable if any of its cells is,
+    #-- otherwise an obstacle if any of its cells is
+    def coarse_state(self, x_coarse, y_coarse, factor):
+        if factor == 1:
+            return self.state(cell_keys(x_coarse, y_coarse))
+        dy, dx = np.mgrid[0:factor, 0:factor]
+        x_cell = np.asarray(x_coarse)[:, None] * factor + dx.ravel()
+        y_cell = np.asarray(y_coarse)[:, None] * factor + dy.ravel()
+        state = self.state(cell_keys(x_cell, y_cell).ravel()).reshape(x_cell.shape)
+        coarse = np.zeros(len(x_cell), dtype=np.int8)
+        coarse[(state == OBSTACLE).any(axis=1)] = OBSTACLE
+        coarse[(state == NAVIGABLE).any(axis=1)] = NAVIGABLE
+        return coarse
+
+    #-- Dense copy of a rows x cols region starting at cell (x0, y0).
+    #-- Returns (logodds, rocks) arrays indexed [y - y0, x - x0]
+    def region(self, x0, y0, rows, cols):
+        logodds = np.zeros((rows, cols), dtype=np.int16)
+        rocks = np.zeros((rows, cols), dtype=np.int16)
+        size = self.tile_size
+        #-- Only the tiles overlapping the region are looked up, so the cost doesn't grow with the map
+        for tile_y in range(y0 // size, (y0 + rows - 1) // size + 1):
+            for tile_x in range(x0 // size, (x0 + cols - 1) // size + 1):
+                tile = self.tiles.get((tile_x, tile_y))
+                if tile is None:
+                    continue
+                tx0, ty0 = tile_x * size, tile_y * size
+                # Overlap of the tile with the region
+                xa, xb = max(tx0, x0), min(tx0 + size, x0 + cols)
+                ya, yb = max(ty0, y0), min(ty0 + size, y0 + rows)
+                tile = tile.reshape(2, size, size)
+                logodds[ya - y0:yb - y0, xa - x0:xb - x0] = tile[0, ya - ty0:yb - ty0, xa - tx0:xb - tx0]
+                rocks[ya - y0:yb - y0, xa - x0:xb - x0] = tile[1, ya - ty0:yb - ty0, xa - tx0:xb - tx0]
+        return logodds, rocks
+
+    #-- Dense state (UNKNOWN, NAVIGABLE or OBSTACLE) of a region, indexed [y - y0, x - x0]
+    def region_state(self, x0, y0, rows, cols):
+        return self._classify(self.region(x0, y0, rows, cols)[0])
+
+    #-- A region of the map in the original worldmap layout: obstacles on the RED layer,
+    #-- rock samples on the GREEN layer and navigable terrain on the BLUE layer, 255 where set
+    def as_rgb(self, x0, y0, rows, cols):
+        logodds, rocks = self.region(x0, y0, rows, cols)
+        state = self._classify(logodds)
+        rgb = np.zeros((rows, cols, 3), dtype=np.uint8)
+        rgb[:,:,0][state == OBSTACLE] = 255
+        rgb[:,:,1][rocks > 0] = 255
+        rgb[:,:,2][state == NAVIGABLE] = 255
+        return rgb
+
+#-- Cache of the world cells seen from a pose, for frames where the rover stands still or
+#-- turns in place (start, stop, pickup and stuck modes) and sees the same thing again.
+#-- Entries are keyed by the pose quantized to position_step meters and angle_step degrees,
+#-- plus any extra key values, such as the pixel counts of the frame, that must also match.
+#-- The least recently used entry is evicted once there are more than `capacity` entries
+class WorldCellCache():
+    def __init__(self, capacity=128, position_step=0.02, angle_step=0.1):
+        self.capacity = capacity
+        self.position_step = position_step
+        self.angle_step = angle_step
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    #-- Cache key of a pose (meters and degrees) and extra key values
+    def key(self, pos, yaw, pitch, roll, extra=()):
+        turn = int(round(360 / self.angle_step))
+        return ((int(round(pos[0] / self.position_step)), int(round(pos[1] / self.position_step)))
+                + tuple(int(round(angle / self.angle_step)) % turn for angle in (yaw, pitch, roll))
+                + tuple(extra))
+
+    #-- Cached cells for key, or None
+    def get(self, key):
+        cells = self.entries.get(key)
+        if cells is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return cells
+
+    def put(self, key, cells):
+        self.entries[key] = cells
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()